@@ -0,0 +1,90 @@
+from functools import lru_cache
+import pandas as pd
+
+from .tidal import default_tidal_constituents, tidal_matrix, tidal_periods_range
+
+calendar_columns = ['month', 'day', 'week', 'hour', 'minute', 'dayofweek']
+
+
+def calendar_features(index: pd.DatetimeIndex, columns: list = calendar_columns) -> pd.DataFrame:
+    """Time features, like month or hour, for a datetime index."""
+    features = dict(
+        month=lambda i: i.month,
+        day=lambda i: i.day,
+        week=lambda i: i.isocalendar().week.values,
+        hour=lambda i: i.hour,
+        minute=lambda i: i.minute,
+        dayofweek=lambda i: i.dayofweek,
+    )
+    return pd.DataFrame({c: features[c](index) for c in columns}, index=index)
+
+
+class CovariateProvider:
+    """
+    Makes forecast columns, which are known functions of time, for any timestamps.
+
+    This lets us make x_future at forecast time, without building and normalizing a DataFrame of the whole dataset. Subclasses implement `generate`. Regular ranges are LRU cached, so don't modify the result of `range`.
+    """
+    columns = []
+
+    def __init__(self, maxsize=128):
+        self._range = lru_cache(maxsize)(self._generate_range)
+
+    def generate(self, index: pd.DatetimeIndex) -> pd.DataFrame:
+        raise NotImplementedError()
+
+    def __call__(self, index) -> pd.DataFrame:
+        return self.generate(pd.DatetimeIndex(index))
+
+    def _generate_range(self, start: pd.Timestamp, periods: int, freq: str) -> pd.DataFrame:
+        return self.generate(pd.date_range(start, periods=periods, freq=freq))
+
+    def range(self, start, periods: int, freq) -> pd.DataFrame:
+        """Covariates for `periods` regular steps from `start`."""
+        freq = pd.tseries.frequencies.to_offset(freq).freqstr
+        return self._range(pd.Timestamp(start), periods, freq)
+
+    def __repr__(self):
+        return f'<{type(self).__name__}({self.columns})>'
+
+
+class CalendarCovariates(CovariateProvider):
+    """
+    Calendar features, and optionally a holiday flag.
+
+    Args:
+    - holidays: Timestamps which are flagged as a holiday. Holidays we don't know about will be False
+    """
+
+    def __init__(self, columns: list = calendar_columns, holidays=None, maxsize=128):
+        super().__init__(maxsize=maxsize)
+        self.columns = list(columns)
+        self.holidays = pd.DatetimeIndex(holidays if holidays is not None else [])
+
+    def generate(self, index):
+        df = calendar_features(index, [c for c in self.columns if c != 'holiday'])
+        if 'holiday' in self.columns:
+            df['holiday'] = index.isin(self.holidays)
+        return df[self.columns]
+
+
+class TidalCovariates(CovariateProvider):
+    """
+    Tidal constituents.
+
+    Args:
+    - t0: The start time used when the training data was generated, since the nodal corrections depend on it
+    """
+
+    def __init__(self, t0, constituents: list = default_tidal_constituents, maxsize=128):
+        super().__init__(maxsize=maxsize)
+        self.t0 = pd.Timestamp(t0)
+        self.columns = list(constituents)
+
+    def generate(self, index):
+        td = (index - self.t0).total_seconds().to_numpy().astype(int)
+        return pd.DataFrame(tidal_matrix(td, self.t0, self.columns), columns=self.columns, index=index)
+
+    def _generate_range(self, start, periods, freq):
+        # This one has it's own block cache, which reuses overlapping ranges
+        return tidal_periods_range(self.t0, start, periods, freq, self.columns)
@@ -1,48 +1,146 @@
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 from torchvision.datasets.utils import download_url, extract_archive, download_and_extract_archive
 import os
 from tqdm.auto import tqdm
 from pathlib import Path
-from sklearn_pandas import DataFrameMapper
 import xarray as xr
 import pandas as pd
 import numpy as np
 import zipfile
-
-from .dataset import Seq2SeqDataSet
-from .util import normalize_encode_dataframe, timeseries_split
+import shutil
+import hashlib
+import inspect
+import json
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
+from .dataset import Seq2SeqDataSet, Seq2SeqIterableDataSet, SeriesBuffer, extend_buffer
+from .util import timeseries_split, save_columnar, load_columnar, frame_from_columns, datetime_index
+from .scaler import StreamingScaler
 from ..util import dset_to_nc, logger
 from .tidal import generate_tidal_periods
+from .covariates import CovariateProvider, CalendarCovariates, TidalCovariates, calendar_features
+from .resample import resample
+
+def _update_source_hash(h, functions):
+    """Add the source code of each function to hash `h`."""
+    for f in functions:
+        try:
+            source = inspect.getsource(f).encode()
+        except (OSError, TypeError):
+            # e.g. defined in a notebook
+            source = f.__code__.co_code
+        h.update(source)
+
 
 class RegressionForecastData:   
     columns_forecast = None # The input colums which can be included in future (e.g. week or weather forecast)
     columns_target = None # Target columns
+    float_dtype = np.float32 # Storage dtype of the float columns in df, df_norm and the splits
+    covariate_dtype = np.float32 # Storage dtype of the inputs in each Seq2SeqDataSet, np.float16 halves it again
+    irregular = False # The index has no freq, rows are only where there is data. Use `max_span` in `to_datasets` to skip windows across gaps
+    download_functions = [] # Module level functions that `download` calls, their code is part of the raw cache's `download_key`
     
-    def __init__(self, datasets_root):        
+    def __init__(self, datasets_root, irregular=None):
+        """
+        Args:
+        - irregular: Override the class's `irregular`, for datasets whose `download` supports both
+        """
         self.datasets_root = datasets_root
+        if irregular is not None:
+            self.irregular = irregular
+        self._buffers = {} # Normalized SeriesBuffer's, for each (skip_gaps, dtype)
+        self._full = {} # Column buffers with spare capacity, for each frame that `append` grows
 
         name = type(self).__name__
-        self.cache_file = self.datasets_root / f"._cache_{name}.pkl"
+        if self.irregular:
+            # The raw data is different, so it needs it's own cache
+            name += '_irregular'
+        self.cache_file = self.datasets_root / f"._cache_{name}"
         
         # Process data
         self.df = self.download_cache()        
-        self.df_norm, self.scaler = self.normalize(self.df)
-        self.output_scaler = next(filter(lambda r:r[0][0] in self.columns_target, self.scaler.features))[-1]
-        self.df_train, self.df_val, self.df_test = self.split(self.df_norm)
+        self.df_norm, self.scaler, (self.df_train, self.df_val, self.df_test) = self.normalize_split_cache(self.df)
+        self.output_scaler = self.scaler.subset(self.columns_target)
         
         # Check processing
         self.check()
 
     def clear_cache(self, ):
-        print(f'rm {self.cache_file}')
-        os.remove(self.cache_file)
+        for f in [self.cache_file] + self._norm_cache_files():
+            print(f'rm -r {f}')
+            shutil.rmtree(f)
+
+    def download_key(self) -> str:
+        """Hash of the code that makes the raw data: `download` and the `download_functions` it calls."""
+        h = hashlib.sha1()
+        _update_source_hash(h, [self.download] + list(self.download_functions))
+        return h.hexdigest()[:16]
 
     def download_cache(self):
-        if not self.cache_file.exists():
-            logger.info(f"Using cache file {self.cache_file}")
-            df = self.download()
-            df.to_pickle(self.cache_file)
-        return pd.read_pickle(self.cache_file)
+        """
+        Load the raw data from a folder of memory mappable columns, downloading it the first time.
+
+        The folder records the `download_key` it was made with, and is remade when the download code changes.
+        """
+        key = self.download_key()
+        key_file = self.cache_file / 'download_key'
+        if not (key_file.exists() and key_file.read_text() == key):
+            old_cache_file = self.cache_file.with_name(self.cache_file.name + '.pkl')
+            if not self.cache_file.exists() and old_cache_file.exists():
+                # Convert caches from when we used pickle
+                df = pd.read_pickle(old_cache_file)
+            else:
+                df = self.download()
+            logger.info(f"Writing cache file {self.cache_file}")
+            save_columnar(df, self.cache_file, float_dtype=self.float_dtype)
+            key_file.write_text(key)
+        return load_columnar(self.cache_file, float_dtype=self.float_dtype)
+
+    def _norm_cache_files(self):
+        return list(self.datasets_root.glob(f"{self.cache_file.name}_norm_*"))
+
+    def cache_key(self) -> str:
+        """
+        Hash of the raw data cache, the column config, and the code that processes it.
+
+        The raw data is identified by its cache folder's meta data, and each file's size and modification time, so this doesn't read the data. The folder's `download_key` file covers the download code.
+        """
+        h = hashlib.sha1()
+        h.update((self.cache_file / 'meta.json').read_bytes())
+        for f in sorted(self.cache_file.iterdir()):
+            st = f.stat()
+            h.update(f'{f.name}:{st.st_size}:{st.st_mtime_ns}'.encode())
+        h.update(json.dumps([self.columns_target, self.columns_forecast]).encode())
+        _update_source_hash(h, [self.normalize, self.split])
+        return h.hexdigest()[:16]
+
+    def normalize_split_cache(self, df: pd.DataFrame):
+        """Normalize and split, or load the results from a cache next to the raw data cache."""
+        cache_dir = self.datasets_root / f"{self.cache_file.name}_norm_{self.cache_key()}"
+        if not cache_dir.exists():
+            df_norm, scaler = self.normalize(df)
+            splits = self.split(df_norm)
+
+            # Remove stale caches, then write this one
+            for f in self._norm_cache_files():
+                shutil.rmtree(f)
+            logger.info(f"Writing cache file {cache_dir}")
+            tmp = cache_dir.with_name(cache_dir.name + '.tmp')
+            tmp.mkdir(parents=True, exist_ok=True)
+            save_columnar(df_norm, tmp / 'df_norm', float_dtype=self.float_dtype)
+            (tmp / 'scaler.json').write_text(json.dumps(scaler.to_dict()))
+            bounds = [[int(df_norm.index.get_loc(d.index[0])), int(df_norm.index.get_loc(d.index[-1])) + 1] for d in splits]
+            (tmp / 'splits.json').write_text(json.dumps(bounds))
+            tmp.rename(cache_dir)
+
+        # Load it even if we just made it, so it's the same dtype and memory mapped either way
+        df_norm = load_columnar(cache_dir / 'df_norm', float_dtype=self.float_dtype)
+        scaler = StreamingScaler.from_dict(json.loads((cache_dir / 'scaler.json').read_text()))
+        bounds = json.loads((cache_dir / 'splits.json').read_text())
+        splits = [df_norm.iloc[a:b] for a, b in bounds]
+        self.norm_cache_dir, self.split_bounds = cache_dir, bounds
+        return df_norm, scaler, splits
 
     @property
     def columns_past(self):
@@ -53,8 +151,9 @@ class RegressionForecastData:
         raise NotImplementedError()
         return df
     
-    def normalize(self, df) -> Tuple[pd.DataFrame, DataFrameMapper]:
-        df_norm, scaler = normalize_encode_dataframe(df)
+    def normalize(self, df) -> Tuple[pd.DataFrame, StreamingScaler]:
+        scaler = StreamingScaler().fit(df)
+        df_norm = scaler.transform(df)
         return df_norm, scaler
     
     def split(self, df_norm: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
@@ -65,26 +164,151 @@ class RegressionForecastData:
     def check(self) -> None:
         """Check the resulting dataframe"""
         assert isinstance(self.df.index, pd.DatetimeIndex), 'index must be datetime'
-        assert self.df.index.freq is not None, 'df must have freq'        
+        if not self.irregular:
+            assert self.df.index.freq is not None, 'df must have freq'
         assert self.columns_forecast is not None
         assert self.columns_target is not None
         assert ~set(self.columns_target).issubset(set(self.columns_forecast)), 'target columns should not be in forecast'
         assert set(self.columns_forecast).issubset(set(self.df.columns)), 'columns_forecast must be in df'
         assert set(self.columns_target).issubset(set(self.df.columns)), 'columns_target must be in df'
         
-    def to_datasets(self, window_past: int, window_future: int, valid:bool=False) -> Tuple[Seq2SeqDataSet, Seq2SeqDataSet]:
-        """Convert to torch datasets"""
-        ds_train = Seq2SeqDataSet(self.df_train, window_past=window_past, window_future=window_future, columns_target=self.columns_target, columns_past=self.columns_past)
-        ds_val = Seq2SeqDataSet(self.df_val, window_past=window_past, window_future=window_future, columns_target=self.columns_target, columns_past=self.columns_past)
-        ds_test = Seq2SeqDataSet(self.df_test, window_past=window_past, window_future=window_future, columns_target=self.columns_target, columns_past=self.columns_past)
+    def make_covariates(self) -> Optional[CovariateProvider]:
+        """Override this to return a provider for `columns_forecast`, if they are a known function of time"""
+        return None
+
+    @property
+    def covariates(self) -> Optional[CovariateProvider]:
+        """The (cached) covariate provider, or None if the forecast columns can't be made on demand"""
+        if getattr(self, '_covariates', None) is None:
+            self._covariates = self.make_covariates()
+        return self._covariates
+
+    def future_covariates(self, start, periods: int, freq=None) -> pd.DataFrame:
+        """
+        Normalized `columns_forecast` for `periods` steps from `start`, e.g. for x_future beyond the end of the data.
+
+        They are made on demand by the covariate provider, and normalized with the scaler.
+
+        Args:
+        - freq: Step size, defaults to the freq of the data. Needed for irregular data
+        """
+        if self.covariates is None:
+            raise NotImplementedError(f'{type(self).__name__} has no covariate provider')
+        freq = freq if freq is not None else self.df.index.freq
+        if freq is None:
+            raise ValueError('The data has no freq, so pass one')
+        df = self.covariates.range(start, periods, freq)
+        df_norm = self.scaler.subset(self.columns_forecast).transform(df)
+        return df_norm[self.columns_forecast].astype(np.float32)
+
+    def to_datasets(self, window_past: int, window_future: int, valid:bool=False, mmap_dir=None, **kwargs) -> Tuple[Seq2SeqDataSet, Seq2SeqDataSet]:
+        """
+        Convert to torch datasets
+
+        Args:
+        - mmap_dir: Optional folder to memory map each split from, so DataLoader workers share one copy
+        - kwargs: Passed to Seq2SeqDataSet, e.g. stride
+        """
+        buffer = self.series_buffer(skip_gaps=kwargs.pop('skip_gaps', False), dtype=kwargs.pop('dtype', None))
+        kwargs = dict(window_past=window_past, window_future=window_future, columns_past=self.columns_past, **kwargs)
+        mmap_dirs = [Path(mmap_dir) / split for split in ['train', 'val', 'test']] if mmap_dir is not None else [None] * 3
+
+        # Each split is a range of rows in the same buffer
+        rows = [buffer.rows_between(df.index[0], df.index[-1]) for df in [self.df_train, self.df_val, self.df_test]]
+        ds_train = Seq2SeqDataSet.from_buffer(buffer, rows[0], mmap_dir=mmap_dirs[0], **kwargs)
+        ds_val = Seq2SeqDataSet.from_buffer(buffer, rows[1], mmap_dir=mmap_dirs[1], **kwargs)
+        ds_test = Seq2SeqDataSet.from_buffer(buffer, rows[2], mmap_dir=mmap_dirs[2], **kwargs)
         return ds_train, ds_val, ds_test
+
+    def series_buffer(self, skip_gaps=False, dtype=None) -> SeriesBuffer:
+        """
+        The whole normalized series as one buffer, which the datasets from `to_datasets` are row ranges of.
+
+        It's made once for each skip_gaps and dtype, so making datasets with other windows, e.g. in a hyperparameter sweep, doesn't copy the data.
+
+        Args:
+        - dtype: Storage dtype of the inputs, defaults to `covariate_dtype`
+        """
+        dtype = np.dtype(dtype if dtype is not None else self.covariate_dtype)
+        key = (skip_gaps, dtype.str)
+        if key not in self._buffers:
+            self._buffers[key] = SeriesBuffer.from_df(self.df_norm, self.columns_target, skip_gaps=skip_gaps, dtype=dtype)
+        return self._buffers[key]
     
+    def append(self, df_new: pd.DataFrame) -> pd.DataFrame:
+        """
+        Add new raw rows, e.g. as they arrive in production, without reloading, refitting or resplitting.
+
+        They are normalized with the existing scaler and added to the latest split, which is val, and to the buffers from `series_buffer`. The frames' columns grow into buffers with spare capacity, so this is amortized O(new rows). The caches are not updated.
+
+        Returns the normalized rows, which can be passed to `Seq2SeqDataSet.append` for datasets from `to_datasets`.
+        """
+        df_new = df_new[self.df.columns].copy()
+        for c in self.df.columns:
+            if isinstance(self.df[c].dtype, pd.CategoricalDtype):
+                df_new[c] = df_new[c].astype(self.df[c].dtype)
+        df_new_norm = self.scaler.transform(df_new)[self.df_norm.columns]
+        if self.float_dtype is not None:
+            floats = df_new.select_dtypes('floating').columns
+            df_new[floats] = df_new[floats].astype(self.float_dtype)
+            df_new_norm = df_new_norm.astype(self.float_dtype)
+
+        freq = self.df.index.freq
+        if (freq is not None) and len(df_new) and not df_new.index.equals(pd.date_range(self.df.index[-1], periods=len(df_new) + 1, freq=freq)[1:]):
+            raise ValueError(f'new rows should continue the index with freq {freq.freqstr}')
+
+        # val is the last rows of df_norm, so it stays a view of it
+        val_start = len(self.df_norm) - len(self.df_val)
+        self.df = self._extend_frame('df', df_new)
+        self.df_norm = self._extend_frame('df_norm', df_new_norm)
+        self.df_val = self.df_norm.iloc[val_start:]
+        for buffer in self._buffers.values():
+            buffer.append(df_new_norm)
+        return df_new_norm
+
+    def _extend_frame(self, name: str, df_new: pd.DataFrame) -> pd.DataFrame:
+        """Append rows to the columns and index of the frame `name`, and make a new frame of views of them."""
+        df = getattr(self, name)
+        full = self._full.setdefault(name, {})
+        data = {}
+        for c in df.columns:
+            if isinstance(df[c].dtype, pd.CategoricalDtype):
+                full[c], codes = extend_buffer(full.get(c), df[c].cat.codes.to_numpy(), df_new[c].cat.codes.to_numpy())
+                data[c] = pd.Categorical.from_codes(codes, dtype=df[c].dtype)
+            else:
+                full[c], data[c] = extend_buffer(full.get(c), df[c].to_numpy(), df_new[c].to_numpy(dtype=df[c].dtype))
+        full['index'], t = extend_buffer(full.get('index'), df.index.asi8, df_new.index.asi8)
+        # We checked the new rows continue the freq
+        index = datetime_index(t, df.index.dtype, freq=df.index.freq, name=df.index.name)
+        return frame_from_columns(data, index)
+
+    def to_iterable_datasets(self, window_past: int, window_future: int, **kwargs) -> Tuple[Seq2SeqIterableDataSet, Seq2SeqIterableDataSet, Seq2SeqIterableDataSet]:
+        """
+        Convert to streaming torch datasets, which read windows from the normalized cache instead of the splits in memory
+
+        Args:
+        - kwargs: Passed to Seq2SeqIterableDataSet, e.g. shuffle_buffer
+        """
+        kwargs = dict(window_past=window_past, window_future=window_future, columns_target=self.columns_target, columns_past=list(self.columns_past), **kwargs)
+        path = self.norm_cache_dir / 'df_norm'
+        ds_train, ds_val, ds_test = [Seq2SeqIterableDataSet(path, rows=bounds, **kwargs) for bounds in self.split_bounds]
+        return ds_train, ds_val, ds_test
+
     def __repr__(self):
         return f'<{type(self).__name__} {self.df.shape if (self.df is not None) else None}>'
 
     def __len__(self):
         return len(self.df.dropna(subset=self.columns_target))
 
+def read_gas_sensor_csv(zip_path: Path, name: str, columns: List[str], freq: str) -> pd.DataFrame:
+    """Read and resample one csv from the GasSensor zip. It's a top level function so a process pool can call it."""
+    now = pd.to_datetime(Path(name).stem, format='%Y%m%d_%H%M%S')
+    with zipfile.ZipFile(zip_path) as zf:
+        df = pd.read_csv(zf.open(name), usecols=['Time (s)'] + columns, dtype=np.float64, engine='c')
+    df.index = pd.to_timedelta(df.pop('Time (s)'), unit='s') + now
+    return resample(df[columns], freq, how='first')
+
+
 class GasSensor(RegressionForecastData):
     """
     A metal oxide (MOX) gas sensor exposed during 3 weeks to mixtures of carbon monoxide and humid synthetic air in a gas chamber.
@@ -94,30 +318,47 @@ class GasSensor(RegressionForecastData):
     
     columns_target = ['R1 (MOhm)']
     columns_forecast = ['Flow rate (mL/min)', 'Heater voltage (V)']
+    n_jobs = None # Processes used to read the csv's, defaults to the number of cpus
+    download_functions = [read_gas_sensor_csv, resample]
     
     def download(self):
-        # TODO cache in faster format
         url = 'http://archive.ics.uci.edu/ml/machine-learning-databases/00487/gas-sensor-array-temperature-modulation.zip'
         
         # download if needed
-        # extract_path = self.datasets_root/'gas-sensor-array-temperature-modulation.zip'
-        download_url(url, self.datasets_root)
+        zip_path = self.datasets_root / 'gas-sensor-array-temperature-modulation.zip'
+        if not zip_path.exists():
+            download_url(url, self.datasets_root)
     
-        # Load csv's from inside zip
-        zf = zipfile.ZipFile(self.datasets_root / 'gas-sensor-array-temperature-modulation.zip')
-        dfs=[]
-        for f in zf.namelist():
-            if f.endswith('.csv'):
-                now = pd.to_datetime(Path(f).stem, format='%Y%m%d_%H%M%S')
-                df = pd.read_csv(zf.open(f))
-                df.index = pd.to_timedelta(df['Time (s)'], unit='s') + now
-                dfs.append(df)
-        self.df = pd.concat(dfs).dropna(subset=self.columns_target)
-
-        df = df[[ 'CO (ppm)', 'Humidity (%r.h.)', 'Temperature (C)',
-            'Flow rate (mL/min)', 'Heater voltage (V)', 'R1 (MOhm)']]
-        df = df.resample('0.3S').first()
-        return df
+        # Read and resample each csv from inside the zip in parallel, so we only hold a few raw files at once
+        columns = [ 'CO (ppm)', 'Humidity (%r.h.)', 'Temperature (C)',
+            'Flow rate (mL/min)', 'Heater voltage (V)', 'R1 (MOhm)']
+        freq = '0.3S'
+        with zipfile.ZipFile(zip_path) as zf:
+            names = sorted(f for f in zf.namelist() if f.endswith('.csv'))
+
+        # Merge each csv onto the freq grid as it arrives, so we never hold them all. The files are named by their start
+        # time, so in sorted order they can only overlap the end of the rows so far, and we keep the first of those rows
+        step = pd.Timedelta(freq).value
+        t0 = None
+        full, data = {}, {c: np.empty(0) for c in columns}
+        with ProcessPoolExecutor(self.n_jobs) as pool:
+            for df in tqdm(pool.map(read_gas_sensor_csv, repeat(zip_path), names, repeat(columns), repeat(freq)), total=len(names), desc='GasSensor', leave=False):
+                if len(df) == 0:
+                    continue
+                t = df.index.asi8
+                if t0 is None:
+                    t0, name = t[0], df.index.name
+                n = len(data[columns[0]])
+                rows = (t - t0) // step
+                new = rows >= n
+                for c in columns:
+                    # Rows between files are gaps, which are nan like `asfreq`
+                    block = np.full(max(rows[-1] + 1 - n, 0), np.nan)
+                    block[rows[new] - n] = df[c].to_numpy()[new]
+                    full[c], data[c] = extend_buffer(full.get(c), data[c], block)
+        n = len(data[columns[0]])
+        index = datetime_index(t0 + step * np.arange(n, dtype=np.int64), np.dtype('datetime64[ns]'), freq=pd.tseries.frequencies.to_offset(freq), name=name)
+        return frame_from_columns(data, index)
 
 
 class MetroInterstateTraffic(RegressionForecastData):
@@ -130,6 +371,11 @@ class MetroInterstateTraffic(RegressionForecastData):
     columns_target = ['traffic_volume']
     columns_forecast = ['holiday', 'month', 'day', 'week', 'hour',
        'minute', 'dayofweek']
+    download_functions = [resample]
+
+    def make_covariates(self):
+        # We only know the holidays in the data, later ones will be False
+        return CalendarCovariates(self.columns_forecast, holidays=self.df.index[self.df['holiday']])
     
     def download(self):
         url = 'https://archive.ics.uci.edu/ml/machine-learning-databases/00492/Metro_Interstate_Traffic_Volume.csv.gz'
@@ -139,24 +385,16 @@ class MetroInterstateTraffic(RegressionForecastData):
         local_path = self.datasets_root/filename
         if not local_path.exists():
             download_url(url, self.datasets_root, filename)
-        df = (pd.read_csv(local_path, index_col='date_time', parse_dates=['date_time'])
-              .dropna(subset=self.columns_target)
-              .resample('1H').first()
-             )
+        df = pd.read_csv(local_path, index_col='date_time', parse_dates=['date_time']).dropna(subset=self.columns_target)
+        df = resample(df, '1H', how='first')
         
         # Make holiday a bool
         df['holiday'] = ~df['holiday'].isna()
         df['weather_main'] = df['weather_main'].fillna('none')
         df['weather_description'] = df['weather_description'].fillna('none')
         
-        # Add time features 
-        time = df.index.to_series()
-        df["month"] = time.dt.month
-        df['day'] = time.dt.day
-        df['week'] = time.dt.isocalendar().week
-        df['hour'] = time.dt.hour
-        df['minute'] = time.dt.minute
-        df['dayofweek'] = time.dt.dayofweek
+        # Add time features, the same way the covariate provider makes them at forecast time
+        df = df.join(calendar_features(df.index))
         
         return df
 
@@ -170,6 +408,10 @@ class AppliancesEnergyPrediction(RegressionForecastData):
     columns_target = ['log_Appliances']
     columns_forecast = ['month', 'day', 'week', 'hour',
        'minute', 'dayofweek']
+    download_functions = [resample]
+
+    def make_covariates(self):
+        return CalendarCovariates(self.columns_forecast)
     
     def download(self):
         url = 'https://archive.ics.uci.edu/ml/machine-learning-databases/00374/energydata_complete.csv'
@@ -184,16 +426,10 @@ class AppliancesEnergyPrediction(RegressionForecastData):
         # log target
         df['log_Appliances'] = np.log(df['Appliances'] + 1e-5)
         df = df.drop(columns=['Appliances'])
-        df = df.dropna(subset=self.columns_target).resample('10T').first()
+        df = resample(df.dropna(subset=self.columns_target), '10T', how='first')
         
-        # Add time features 
-        time = df.index.to_series()
-        df["month"] = time.dt.month
-        df['day'] = time.dt.day
-        df['week'] = time.dt.isocalendar().week
-        df['hour'] = time.dt.hour
-        df['minute'] = time.dt.minute
-        df['dayofweek'] = time.dt.dayofweek
+        # Add time features, the same way the covariate provider makes them at forecast time
+        df = df.join(calendar_features(df.index))
         
         return df
 
@@ -210,6 +446,10 @@ class BejingPM25(RegressionForecastData):
     columns_target = ['log_pm2.5']
     columns_forecast = ['month', 'day', 'week', 'hour',
        'minute', 'dayofweek']
+    download_functions = [resample]
+
+    def make_covariates(self):
+        return CalendarCovariates(self.columns_forecast)
     
     def download(self):
         url = 'http://archive.ics.uci.edu/ml/machine-learning-databases/00381/PRSA_data_2010.1.1-2014.12.31.csv'
@@ -228,77 +468,100 @@ class BejingPM25(RegressionForecastData):
         df = df.drop(columns=['pm2.5'])
         
         df.dropna(subset=self.columns_target, inplace=True)
-        df = df.resample('1H').first()
+        df = resample(df, '1H', how='first')
         
         df['cbwd'] = df['cbwd'].fillna('none')
         
         
         
-        # Add time features 
-        time = df.index.to_series()
-        df["month"] = time.dt.month
-        df['day'] = time.dt.day
-        df['week'] = time.dt.isocalendar().week
-        df['hour'] = time.dt.hour
-        df['minute'] = time.dt.minute
-        df['dayofweek'] = time.dt.dayofweek
+        # Add time features, the same way the covariate provider makes them at forecast time
+        df = df.join(calendar_features(df.index))
         
 #         df['log_pm2.5'] = np.log(df['pm2.5']+1e-5)
         
         return df
 
+# All the current meter deployments at this mooring
+imos_current_files_all = [
+    "IMOS_ANMN-WA_AETVZ_20090715T080000Z_WATR20_FV01_WATR20-0907-Continental-194_END-20090716T181317Z_C-20191122T052830Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20100409T080000Z_WATR20_FV01_WATR20-1004-Continental-194_END-20100430T084500Z_C-20191122T053845Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20101222T080000Z_WATR20_FV01_WATR20-1012-Continental-194_END-20110518T051500Z_C-20200916T020035Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20110608T080000Z_WATR20_FV01_WATR20-1106-Continental-194_END-20111122T035000Z_C-20200916T025619Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20111221T060300Z_WATR20_FV01_WATR20-1112-Continental-194_END-20120704T050500Z_C-20200916T043212Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20120726T044000Z_WATR20_FV01_WATR20-1207-Continental-194_END-20130204T044000Z_C-20200916T032027Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20130221T080000Z_WATR20_FV01_WATR20-1302-Continental-194_END-20131003T035000Z_C-20180529T020609Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20131111T080000Z_WATR20_FV01_WATR20-1311-Continental-194_END-20140519T035000Z_C-20200114T033335Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20140710T080000Z_WATR20_FV01_WATR20-1407-Continental-194_END-20150121T021500Z_C-20180529T055902Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20150213T080000Z_WATR20_FV01_WATR20-1502-Continental-194_END-20150424T134002Z_C-20200114T035347Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20150914T080000Z_WATR20_FV01_WATR20-1509-Continental-194_END-20160331T043000Z_C-20180601T013623Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20160427T080000Z_WATR20_FV01_WATR20-1604-Continental-194_END-20160531T021800Z_C-20180531T071709Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20170512T080000Z_WATR20_FV01_WATR20-1705-Continental-194_END-20170717T014558Z_C-20190805T004647Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20171204T080000Z_WATR20_FV01_WATR20-1712-Continental-194_END-20180618T030000Z_C-20180620T233149Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20180802T080000Z_WATR20_FV01_WATR20-1807-Continental-194_END-20190225T054500Z_C-20190227T001343Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20190307T080000Z_WATR20_FV01_WATR20-1903-Continental-194_END-20190911T003144Z_C-20200114T045053Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20190926T080000Z_WATR20_FV01_WATR20-1909-Continental-194_END-20200326T030000Z_C-20200420T064334Z.nc",
+]
+# The ones we use by default
+imos_current_files = [
+    "IMOS_ANMN-WA_AETVZ_20110608T080000Z_WATR20_FV01_WATR20-1106-Continental-194_END-20111122T035000Z_C-20200916T025619Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20111221T060300Z_WATR20_FV01_WATR20-1112-Continental-194_END-20120704T050500Z_C-20200916T043212Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20120726T044000Z_WATR20_FV01_WATR20-1207-Continental-194_END-20130204T044000Z_C-20200916T032027Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20130221T080000Z_WATR20_FV01_WATR20-1302-Continental-194_END-20131003T035000Z_C-20180529T020609Z.nc",
+    "IMOS_ANMN-WA_AETVZ_20131111T080000Z_WATR20_FV01_WATR20-1311-Continental-194_END-20140519T035000Z_C-20200114T033335Z.nc",
+]
+imos_current_vars = [
+    'VCUR', 'VCUR_quality_control', 'UCUR', 'UCUR_quality_control', 'WCUR', 'WCUR_quality_control', 'TEMP', 'TEMP_quality_control', 'PRES_REL', 'PRES_REL_quality_control', 'DEPTH', 'DEPTH_quality_control', 'ROLL',
+    'PITCH'
+]
+
+
+def _select_current_vars(xd: xr.Dataset) -> xr.Dataset:
+    """Preprocess each deployment file so they can be combined, and so we only read one height."""
+    return xd[imos_current_vars].isel(HEIGHT_ABOVE_SENSOR=18)
+
+
 def get_current_timeseries(
         cache_folder=Path("../data/raw/IMOS_ANMN/"),
         outfile=Path(
             '../data/processed/currents/MOS_ANMN-WA_AETVZ_WATR20_FV01_WATR20-1909-Continental-194_currents.nc'
-        )):
+        ),
+        files=imos_current_files,
+        chunks={'TIME': 100000}):
     """
     Download Current data from the IMOS and pre-process.
+
+    The deployments are opened lazily as one chunked dask dataset, so QC and speed are computed for each chunk in parallel, and we never hold all the heights in memory. This means we can use `files=imos_current_files_all`.
     """
     if not outfile.exists():
-
-        files = [
-            # "IMOS_ANMN-WA_AETVZ_20090715T080000Z_WATR20_FV01_WATR20-0907-Continental-194_END-20090716T181317Z_C-20191122T052830Z.nc",
-            # "IMOS_ANMN-WA_AETVZ_20100409T080000Z_WATR20_FV01_WATR20-1004-Continental-194_END-20100430T084500Z_C-20191122T053845Z.nc",
-            # "IMOS_ANMN-WA_AETVZ_20101222T080000Z_WATR20_FV01_WATR20-1012-Continental-194_END-20110518T051500Z_C-20200916T020035Z.nc",
-            "IMOS_ANMN-WA_AETVZ_20110608T080000Z_WATR20_FV01_WATR20-1106-Continental-194_END-20111122T035000Z_C-20200916T025619Z.nc",
-            "IMOS_ANMN-WA_AETVZ_20111221T060300Z_WATR20_FV01_WATR20-1112-Continental-194_END-20120704T050500Z_C-20200916T043212Z.nc",
-            "IMOS_ANMN-WA_AETVZ_20120726T044000Z_WATR20_FV01_WATR20-1207-Continental-194_END-20130204T044000Z_C-20200916T032027Z.nc",
-            "IMOS_ANMN-WA_AETVZ_20130221T080000Z_WATR20_FV01_WATR20-1302-Continental-194_END-20131003T035000Z_C-20180529T020609Z.nc",
-            "IMOS_ANMN-WA_AETVZ_20131111T080000Z_WATR20_FV01_WATR20-1311-Continental-194_END-20140519T035000Z_C-20200114T033335Z.nc",
-            # "IMOS_ANMN-WA_AETVZ_20140710T080000Z_WATR20_FV01_WATR20-1407-Continental-194_END-20150121T021500Z_C-20180529T055902Z.nc",
-            # "IMOS_ANMN-WA_AETVZ_20150213T080000Z_WATR20_FV01_WATR20-1502-Continental-194_END-20150424T134002Z_C-20200114T035347Z.nc",
-            # "IMOS_ANMN-WA_AETVZ_20150914T080000Z_WATR20_FV01_WATR20-1509-Continental-194_END-20160331T043000Z_C-20180601T013623Z.nc",
-            # "IMOS_ANMN-WA_AETVZ_20160427T080000Z_WATR20_FV01_WATR20-1604-Continental-194_END-20160531T021800Z_C-20180531T071709Z.nc",
-            #     "IMOS_ANMN-WA_AETVZ_20170512T080000Z_WATR20_FV01_WATR20-1705-Continental-194_END-20170717T014558Z_C-20190805T004647Z.nc",
-            # "IMOS_ANMN-WA_AETVZ_20171204T080000Z_WATR20_FV01_WATR20-1712-Continental-194_END-20180618T030000Z_C-20180620T233149Z.nc",
-            # "IMOS_ANMN-WA_AETVZ_20180802T080000Z_WATR20_FV01_WATR20-1807-Continental-194_END-20190225T054500Z_C-20190227T001343Z.nc",
-            # "IMOS_ANMN-WA_AETVZ_20190307T080000Z_WATR20_FV01_WATR20-1903-Continental-194_END-20190911T003144Z_C-20200114T045053Z.nc",
-            # "IMOS_ANMN-WA_AETVZ_20190926T080000Z_WATR20_FV01_WATR20-1909-Continental-194_END-20200326T030000Z_C-20200420T064334Z.nc",
-        ]
         base = "http://thredds.aodn.org.au/thredds/fileServer/IMOS/ANMN/WA/WATR20/Velocity/"
 
         # Download files
-        [download_url(base + f, cache_folder) for f in files]
-
-        # load and merge
-        xds = [xr.open_dataset(cache_folder / f) for f in files]
-        vars = [
-            'VCUR', 'VCUR_quality_control', 'UCUR', 'UCUR_quality_control', 'WCUR', 'WCUR_quality_control', 'TEMP', 'TEMP_quality_control', 'PRES_REL', 'PRES_REL_quality_control', 'DEPTH', 'DEPTH_quality_control', 'ROLL',
-            'PITCH'
-        ]
-        xds2 = [x[vars].isel(HEIGHT_ABOVE_SENSOR=18) for x in xds]
-        xd = xr.concat(xds2, dim='TIME')
+        [download_url(base + f, cache_folder) for f in files if not (cache_folder / f).exists()]
+
+        # load and merge lazily
+        xd = xr.open_mfdataset(
+            [cache_folder / f for f in files],
+            preprocess=_select_current_vars,
+            combine='nested',
+            concat_dim='TIME',
+            chunks=chunks,
+            parallel=True,
+            data_vars='minimal',
+            coords='minimal',
+            compat='override',
+        )
         xd = xd.where(
             (xd.DEPTH > 150) & (xd.VCUR_quality_control < 2) & (xd.UCUR_quality_control < 2) &
             (xd.PRES_REL_quality_control < 2)  &
             (xd.TEMP_quality_control < 2)  
             )  # remove bad data
+        xd['SPD'] = np.sqrt(xd.VCUR**2 + xd.UCUR**2)
 
-        xd['TIME'] = xd['TIME'].dt.round('10T')
+        # Run the chunks, the result is only one height so it fits in memory
+        xd = xd.compute()
+
+        xd = resample(xd, '10T', how='first', dim='TIME', dense=False)
         xd = xd.dropna(dim='TIME', subset=['VCUR', 'UCUR', 'WCUR'])
-        xd['SPD'] = np.sqrt(xd.VCUR**2 + xd.UCUR**2)
-        # xd = xd.resample(TIME='10T').first() # slow
 
         # Generate tidal freqs
         t = xd.TIME.to_series()
@@ -317,6 +580,8 @@ class IMOSCurrentsVel(RegressionForecastData):
     """
     
     Current Speed at Two Rocks, Western Australia, with a water depth of 200 m. The mooring is located at Lat -31.719 Lon 115.03. Has tidal periods as features.
+
+    It's resampled to a regular 30 minute grid. With `irregular=True` only the 30 minute bins with data are kept, since the deployments have long gaps between them.
     
     see:
     - https://catalogue-imos.aodn.org.au/geonetwork/srv/api/records/bbfc20d3-0e98-40a8-bd8a-3f7717eafb6d
@@ -330,15 +595,25 @@ class IMOSCurrentsVel(RegressionForecastData):
         'M2', 'S2', 'N2', 'K2', 'K1', 'O1', 'P1', 'Q1', 'M4', 'M6', 'S4',
         'MK3', 'MM', 'SSA', 'SA'
     ]
+    download_functions = [get_current_timeseries, _select_current_vars, resample]
+
+    @property
+    def currents_file(self):
+        return self.datasets_root / 'MOS_ANMN-WA_AETVZ_WATR20_FV01_WATR20-1909-Continental-194_currents.nc'
 
     def clear_cache(self):
         super().clear_cache()
-        cache_file2 = self.datasets_root / 'MOS_ANMN-WA_AETVZ_WATR20_FV01_WATR20-1909-Continental-194_currents.nc'
-        print(f'rm {cache_file2}')
-        os.remove(cache_file2)
+        print(f'rm {self.currents_file}')
+        os.remove(self.currents_file)
+
+    def make_covariates(self):
+        # The nodal corrections depend on the start time used in `get_current_timeseries`
+        with xr.open_dataset(self.currents_file) as xd:
+            t0 = pd.Timestamp(xd.TIME.values[0])
+        return TidalCovariates(t0, self.columns_forecast)
 
     def download(self):
-        outfile = self.datasets_root / 'MOS_ANMN-WA_AETVZ_WATR20_FV01_WATR20-1909-Continental-194_currents.nc'
+        outfile = self.currents_file
         get_current_timeseries(outfile=outfile)
 
         # made in previous notebook
@@ -353,6 +628,11 @@ class IMOSCurrentsVel(RegressionForecastData):
         has_past = df.SPD.isna().rolling(48).sum()<5
         df = df[has_past]
 
-        df = df.resample('30T').mean()
+        columns = list(df.columns)
+        df = resample(df.drop(columns=self.columns_forecast), '30T', how='mean', dense=not self.irregular)
 
-        return df
+        # The tides at each 30 minute time, rather than the mean over the bin, so they match `make_covariates` when forecasting
+        df_eta = self.make_covariates().generate(df.index)
+        for c in self.columns_forecast:
+            df[c] = df_eta[c].to_numpy()
+        return df[columns]
@@ -2,103 +2,587 @@ import pandas as pd
 import torch.utils.data
 import numpy as np
 import typing
+import copy
+from pathlib import Path
+
+from .util import open_columnar
 
 def assert_normalized(df):
-    stats = df.describe().T
-    np.testing.assert_allclose(stats['mean'].values, 0, atol=0.1), 'means should be normalized to ~0'
-    np.testing.assert_allclose(stats['std'].values, 1, atol=0.1), 'standard deviations should be normalized to ~0'
+    x = df._get_numeric_data().to_numpy(dtype=np.float64)
+    np.testing.assert_allclose(np.nanmean(x, 0), 0, atol=0.1, err_msg='means should be normalized to ~0')
+    np.testing.assert_allclose(np.nanstd(x, 0, ddof=1), 1, atol=0.1, err_msg='standard deviations should be normalized to ~1')
 
 def assert_no_objects(df):
     for name, dtype in df.dtypes.iteritems():
         assert dtype.name!='object', f'all objects should be pd.categories. {name} is not'
 
+def attach_shared_memory(name: str):
+    """Attach to an existing shared memory block, without taking ownership of it."""
+    # Imported here, since it's python 3.8+ and only needed with `shared=True`
+    from multiprocessing import shared_memory
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Before python 3.13 this registers it with the resource tracker again, which is harmless in DataLoader workers since they share ours
+        return shared_memory.SharedMemory(name)
+
+
+def extend_buffer(full, a: np.ndarray, new: np.ndarray):
+    """
+    Append `new` to `a`, where `a` is the first rows of the larger buffer `full`.
+
+    The buffer's capacity doubles when it's full, so appending is amortized O(new rows). Returns the buffer and a view of the extended rows.
+    """
+    n, k = len(a), len(new)
+    if (full is None) or (a.base is not full) or (n + k > len(full)):
+        full = np.empty((max(2 * n, n + k, 16),) + a.shape[1:], dtype=a.dtype)
+        full[:n] = a
+    full[n:n + k] = new
+    return full, full[:n + k]
+
+
+def window_view(a: np.ndarray, window: int) -> np.ndarray:
+    """
+    All windows along the first axis, as a read-only view with shape (len(a) - window + 1, window, ...).
+
+    Nothing is copied, so indexing the result with an array of starts is the only allocation.
+    """
+    shape = (max(len(a) - window + 1, 0), window) + a.shape[1:]
+    strides = (a.strides[0],) + a.strides
+    return np.lib.stride_tricks.as_strided(a, shape=shape, strides=strides, writeable=False)
+
+
+def new_rows(df_new: pd.DataFrame, columns_x: list, columns_target: list, skip_gaps: bool, dtype, x_last: np.ndarray, y_last: np.ndarray):
+    """
+    Process rows to append the same way as `SeriesBuffer.from_df`, filling forward from the last current row.
+
+    Returns x, y, t, invalid for the new rows.
+    """
+    if skip_gaps:
+        invalid = df_new[columns_target].isna().any(axis=1).to_numpy()
+    else:
+        df_new = df_new.dropna(subset=columns_target)
+        invalid = np.zeros(len(df_new), dtype=bool)
+    x = df_new[columns_x].to_numpy(dtype=dtype)
+    y = df_new[columns_target].to_numpy(dtype=np.float32)
+    x = ffill(np.concatenate([x_last, x]))[len(x_last):]
+    if skip_gaps:
+        y = ffill(np.concatenate([y_last, y]))[len(y_last):]
+    return x, y, df_new.index.asi8, invalid
+
+
+class WindowFeatures:
+    """
+    Turns batches of windows into x_past, y_past, x_future, y_future.
+
+    Shared by the datasets, which set `window_past`, `window_future` and `_icol_blank`, then call `_set_time_features` and `_set_blank_mask`.
+    """
+
+    def _set_time_features(self, freq):
+        """With a fixed freq the relative time features are the same for every window, so make them once."""
+        window = self.window_past + self.window_future
+        self._time_features = None
+        self._step = None
+        if freq is not None:
+            try:
+                self._step = pd.tseries.frequencies.to_offset(freq).nanos
+            except ValueError:
+                # Non fixed frequencies like month ends
+                pass
+        if self._step is not None:
+            days_since_present = (np.arange(window) - self.window_past) * self._step * 1e-9 / 60 / 60 / 24  # days
+            is_past = days_since_present < 0
+            self._time_features = np.stack([days_since_present, is_past], -1).astype(np.float32)
+
+    def _set_blank_mask(self, n_features: int):
+        """Which x features to blank in the future, including the 2 time features, so it's one masked copy per batch."""
+        self._blank_mask = np.zeros(n_features + 2, dtype=bool)
+        self._blank_mask[self._icol_blank] = True
+
+    def _components(self, x, y, time, out=None):
+        """
+        Turn a batch of (x, y, time) windows into float32 past and future features.
+
+        Args:
+        - out: Optional float32 arrays to write x_past, y_past, x_future, y_future into, with room for at least this batch
+        """
+        B, W, F = x.shape
+        wp = self.window_past
+        if out is None:
+            xo = np.empty((B, W, F + 2), dtype=np.float32)
+            x_past, x_future = xo[:, :wp], xo[:, wp:]
+            y = y.astype(np.float32, copy=False)
+            y_past, y_future = y[:, :wp], y[:, wp:]
+        else:
+            x_past, y_past, x_future, y_future = [o[:B] for o in out]
+            y_past[...] = y[:, :wp]
+            y_future[...] = y[:, wp:]
+        x_past[..., :F] = x[:, :wp]
+        x_future[..., :F] = x[:, wp:]
+
+        # Add a features: relative hours since present time, is future
+        # Windows that didn't skip any dropped rows span exactly W-1 steps, and can use the precomputed features
+        span = time[:, -1] - time[:, 0]
+        if (self._time_features is not None) and np.all(span == (W - 1) * self._step):
+            x_past[..., F:] = self._time_features[:wp]
+            x_future[..., F:] = self._time_features[wp:]
+        else:
+            days_since_present = (time - time[:, wp:wp + 1]) * 1e-9 / 60 / 60 / 24  # days
+            x_past[..., F] = days_since_present[:, :wp]
+            x_past[..., F + 1] = days_since_present[:, :wp] < 0
+            x_future[..., F] = days_since_present[:, wp:]
+            x_future[..., F + 1] = days_since_present[:, wp:] < 0
 
-class Seq2SeqDataSet(torch.utils.data.Dataset):
+        # Stop it cheating by using future weather measurements. Fill in with last value
+        np.copyto(x_future, x_past[:, :1], where=self._blank_mask)
+
+        # x_future[:, :, self._icol_blank] = 0
+        return x_past, y_past, x_future, y_future
+
+
+class SeriesBuffer:
+    """
+    A whole series as flat buffers: the inputs x, targets y, int64 times t, and which rows have missing targets.
+
+    Datasets made with `Seq2SeqDataSet.from_buffer` are row ranges of it, so the train, val, and test splits can share one copy.
+    """
+
+    def __init__(self, x, y, t, invalid, columns_x, columns_target, freq=None, tz=None, skip_gaps=False):
+        self.x = x
+        self.y = y
+        self.t = t
+        self.invalid = invalid
+        self.columns_x = columns_x
+        self.columns_target = columns_target
+        self.freq = freq
+        self.tz = tz
+        self.skip_gaps = skip_gaps
+        self._full = {} # Buffers with spare capacity, which `append` grows into
+
+    @classmethod
+    def from_df(cls, df: pd.DataFrame, columns_target: list, skip_gaps=False, dtype=np.float32) -> 'SeriesBuffer':
+        """
+        Args:
+        - df: DataFrame with time index, already scaled
+        - skip_gaps: Keep rows with missing targets, and mark them as invalid. Otherwise they are dropped
+        - dtype: Storage dtype of the inputs
+        """
+        assert isinstance(df.index, pd.DatetimeIndex), 'should have a datetime index'
+        assert df.index.is_monotonic_increasing, 'index should be sorted'
+        assert_no_objects(df)
+
+        # Without a freq, the windows are a fixed number of rows, and the time features come from the actual timestamps
+        freq = df.index.freq.freqstr if df.index.freq is not None else None
+        if skip_gaps:
+            # Keep the gaps, so the datasets can leave them out of the windows
+            invalid = df[columns_target].isna().any(axis=1).to_numpy()
+            df = df.ffill()
+        else:
+            df = df.dropna(subset = columns_target).ffill()
+            invalid = np.zeros(len(df), dtype=bool)
+
+        columns_x = list(df.drop(columns = columns_target).columns)
+        x = df[columns_x].to_numpy(dtype=dtype)
+        y = df[columns_target].to_numpy(dtype=np.float32)
+        t = df.index.asi8
+        return cls(x, y, t, invalid, columns_x, list(columns_target), freq=freq, tz=df.index.tz, skip_gaps=skip_gaps)
+
+    def append(self, df_new: pd.DataFrame) -> 'SeriesBuffer':
+        """
+        Add rows to the end, growing the buffers like `Seq2SeqDataSet.append`, so it's amortized O(new rows).
+
+        Datasets already made from it keep the rows they had.
+        """
+        new = new_rows(df_new, self.columns_x, self.columns_target, self.skip_gaps, self.x.dtype, self.x[-1:], self.y[-1:])
+        for name, d in zip(['x', 'y', 't', 'invalid'], new):
+            self._full[name], a = extend_buffer(self._full.get(name), getattr(self, name), d)
+            setattr(self, name, a)
+        return self
+
+    def rows_between(self, start, end):
+        """The (first, last + 1) rows from time `start` to time `end`, inclusive."""
+        a = np.searchsorted(self.t, pd.Timestamp(start).value, side='left')
+        b = np.searchsorted(self.t, pd.Timestamp(end).value, side='right')
+        return int(a), int(b)
+
+    def __len__(self):
+        return len(self.t)
+
+    def __repr__(self):
+        return f'<{type(self).__name__}(shape={self.x.shape[0], self.x.shape[1] + self.y.shape[1]}, dtype={self.x.dtype})>'
+
+
+class Seq2SeqDataSet(WindowFeatures, torch.utils.data.Dataset):
     """
     Takes in dataframe and returns sequences through time.
     
     Returns x_past, y_past, x_future, etc.
     """
     
-    def __init__(self, df: pd.DataFrame, window_past=40, window_future=10, columns_target=['energy(kWh/hh)'], columns_past=[],):
+    def __init__(self, df: pd.DataFrame, window_past=40, window_future=10, columns_target=['energy(kWh/hh)'], columns_past=[], zero_copy=False, mmap_dir=None, stride=1, random_offset=False, skip_gaps=False, max_span=None, shared=False, dtype=np.float32):
         """
         Args:
         - df: DataFrame with time index, already scaled
         - columns_past: The columns we will blank, in the future
+        - zero_copy: Items are read-only window views, use `collate_fn=ds.collate` to turn them into batches
+        - mmap_dir: Save the buffers and index arrays as .npy files here, and memory map them. DataLoader workers then reopen the files instead of receiving copies
+        - stride: Only use every k-th window, since neighbouring windows are mostly the same rows
+        - random_offset: Jitter each strided window by a random offset within its stride. Call `resample_offsets` to redraw them, e.g. each epoch
+        - skip_gaps: Keep rows with missing targets, and only use windows without any missing targets. Otherwise those rows are dropped, and windows can straddle the gaps
+        - max_span: Only use windows that span at most this long, e.g. '2D'. Useful when the index has no freq, and rows are only where there is data
+        - shared: Put the buffers and index arrays in `multiprocessing.shared_memory` (python 3.8+), so DataLoader workers attach to them instead of receiving copies
+        - dtype: Storage dtype of the inputs, e.g. np.float16 to halve their memory. It's cast once here, and batches are always float32
         """
         super().__init__()
-        assert isinstance(df.index, pd.DatetimeIndex), 'should have a datetime index'
-        assert df.index.freq is not None, 'should have freq'
-        assert_no_objects(df)
+        buffer = SeriesBuffer.from_df(df, columns_target, skip_gaps=skip_gaps, dtype=dtype)
+        self._init(buffer, None, window_past, window_future, columns_past, zero_copy=zero_copy, mmap_dir=mmap_dir, stride=stride, random_offset=random_offset, max_span=max_span, shared=shared)
 
-        self.freq = df.index.freq.freqstr
-        self.df = df.dropna(subset = columns_target).ffill()
-        
+    @classmethod
+    def from_buffer(cls, buffer: SeriesBuffer, rows=None, window_past=40, window_future=10, columns_past=[], **kwargs) -> 'Seq2SeqDataSet':
+        """
+        A dataset over a row range of a SeriesBuffer, without copying it.
+
+        Args:
+        - rows: (first, last + 1) rows to use, e.g. a split. Defaults to all
+        - kwargs: See `__init__`, e.g. stride. skip_gaps and dtype come from the buffer
+        """
+        self = cls.__new__(cls)
+        self._init(buffer, rows, window_past, window_future, columns_past, **kwargs)
+        return self
 
+    def _init(self, buffer, rows, window_past, window_future, columns_past, zero_copy=False, mmap_dir=None, stride=1, random_offset=False, max_span=None, shared=False):
+        self.freq = buffer.freq
         self.window_past = window_past
         self.window_future = window_future
-        self.columns_target = columns_target
+        self.columns_target = buffer.columns_target
         self.columns_past = columns_past
+        self.zero_copy = zero_copy
+        self.mmap_dir = Path(mmap_dir) if mmap_dir is not None else None
+        self.shared = shared
+        self._shm = [] # Shared memory blocks backing the buffers
+        self._shm_owner = False # Whether this process made them, and should free them
+        self._stored = [] # Arrays in the mmap files or shared memory, which pickles leave out
+        self.stride = stride
+        self.random_offset = random_offset
+        self.skip_gaps = buffer.skip_gaps
+        self.max_span = pd.Timedelta(max_span) if max_span is not None else None
+        self.tz = buffer.tz
+        self.columns_x = buffer.columns_x
+
+        # For speed, keep one float32 buffer and look at it through strided windows. We don't keep the DataFrame, so workers only see flat buffers
+        self._icol_blank = [self.columns_x.index(n) for n in columns_past]
+        self._set_blank_mask(len(self.columns_x))
+        a, b = rows if rows is not None else (0, len(buffer))
+        self._set_buffers(buffer.x[a:b], buffer.y[a:b], buffer.t[a:b])
+        self._invalid = buffer.invalid[a:b]
+        self._full = {} # Buffers with spare capacity, which `append` grows into
+
+        # Use the freq before we dropped rows
+        self._set_time_features(self.freq)
+
+        # The row each window starts on. When every row can start one, they are implicit, so new windows cost no memory
+        self._valid_starts = self._find_valid_starts() if (self.skip_gaps or (self.max_span is not None)) else None
+        self._rand_index = None
+        self.resample_offsets()
+        self._store_arrays()
+
+    def _find_valid_starts(self, first=0):
+        """
+        Rows that a window can start on, from row `first`.
+
+        With `skip_gaps`, these are the windows without invalid rows. We count the invalid rows in every window at once, with a cumulative sum. With `max_span` they are the windows which end within max_span of their start, compared as int64 nanoseconds.
+        """
+        window = self.window_past + self.window_future
+        starts = np.arange(first, max(len(self._t) - window, first))
+        ok = np.ones(len(starts), dtype=bool)
+        if self.skip_gaps:
+            invalid = self._invalid[first:]
+            n_invalid = np.concatenate([[0], np.cumsum(invalid)])
+            ok &= n_invalid[starts - first + window] == n_invalid[starts - first]
+        if self.max_span is not None:
+            ok &= (self._t[starts + window - 1] - self._t[starts]) <= self.max_span.value
+        return starts[ok]
+
+    def _n_valid_starts(self) -> int:
+        if self._valid_starts is None:
+            return max(len(self._t) - (self.window_past + self.window_future), 0)
+        return len(self._valid_starts)
+
+    def _all_valid_starts(self) -> np.ndarray:
+        """`_valid_starts`, made if they are implicit."""
+        return np.arange(self._n_valid_starts()) if self._valid_starts is None else self._valid_starts
+
+    def _all_starts(self) -> np.ndarray:
+        """`_starts`, made if they are implicit."""
+        return np.arange(len(self)) if self._starts is None else self._starts
+
+    def _start_rows(self, k):
+        """Start rows of the k'th strided windows."""
+        return k if self._starts is None else self._starts[k]
+
+    def resample_offsets(self):
+        """Choose the strided windows, with new random offsets if `random_offset`."""
+        n = self._n_valid_starts()
+        if self.random_offset and self.stride > 1:
+            i = np.arange(0, n, self.stride)
+            i = np.minimum(i + np.random.randint(0, self.stride, size=len(i)), n - 1)
+            starts = i if self._valid_starts is None else self._valid_starts[i]
+            if '_starts' in self._stored:
+                # Update the stored copy, so workers get the new offsets
+                self._update_stored('_starts', starts)
+            else:
+                self._starts = starts
+        elif self._valid_starts is None:
+            self._starts = None if self.stride == 1 else np.arange(0, n, self.stride)
+        else:
+            # A view, not a copy
+            self._starts = self._valid_starts[::self.stride]
 
-        # For speed
-        self._icol_blank = [df.drop(columns = columns_target).columns.tolist().index(n) for n in columns_past]
-        self._x = self.df.drop(columns = self.columns_target).values
-        self._y = self.df[columns_target].values
-        
         # Sometimes we want to have it shuffled, but the same each time
-        np.random.seed(42)
-        self._rand_index = np.random.permutation(len(self))
+        if (self._rand_index is None) or (len(self._rand_index) != len(self)):
+            self._rand_index = np.random.RandomState(42).permutation(len(self))
 
-    def get_components(self, i):
-        """Get past and future rows."""
-        x = self._x[i : i + (self.window_past + self.window_future)].copy()
-        y = self._y[i:i + (self.window_past + self.window_future)].copy()        
-        time = self.df.index.values[i:i + (self.window_past + self.window_future)].copy()
+    def _extend(self, name: str, new: np.ndarray):
+        self._full[name], a = extend_buffer(self._full.get(name), getattr(self, name), new)
+        setattr(self, name, a)
 
-        days = time.astype(int) * 1e-9 / 60 / 60 / 24  # days
-        now = days[self.window_past]
-        
-        # Add a features: relative hours since present time, is future
-        days_since_present = (days - now)[:, None]
-        is_past = days_since_present < 0
-        x = np.concatenate([x, days_since_present, is_past], -1)
-        
-        # Split into future and past
-        x_past = x[:self.window_past]
-        y_past = y[:self.window_past]
-        x_future = x[self.window_past:]
-        y_future = y[self.window_past:]
+    def append(self, df_new: pd.DataFrame):
+        """
+        Add rows to the end, e.g. as they arrive in production, without rebuilding the dataset.
 
-        # Stop it cheating by using future weather measurements. Fill in with last value
-        x_future[:, self._icol_blank] = x_past[0, self._icol_blank]
+        The buffers grow by doubling their capacity, so this is amortized O(new rows). Only the windows that end in the new rows are checked and added, and the shuffled order is extended with an inside-out Fisher-Yates shuffle. Offsets from `resample_offsets` are kept.
 
-        # x_future[:, self._icol_blank] = 0
-        return x_past, y_past, x_future, y_future
+        Args:
+        - df_new: Rows after the current ones, with the same columns and already scaled, e.g. from `RegressionForecastData.append`
+        """
+        assert (self.mmap_dir is None) and not self.shared, 'can only append to in memory buffers'
+        assert (len(df_new) == 0) or (len(self._t) == 0) or (df_new.index[0].value > self._t[-1]), 'new rows should be after the current ones'
+        window = self.window_past + self.window_future
+        n_old = len(self._t)
+        self._valid_starts = self._all_valid_starts()
+        self._starts = self._all_starts()
+
+        # Process them the same way as in __init__, filling forward from our last row
+        x, y, t, invalid = new_rows(df_new, self.columns_x, self.columns_target, self.skip_gaps, self._x.dtype, self._x[-1:], self._y[-1:])
+
+        self._extend('_x', x)
+        self._extend('_y', y)
+        self._extend('_t', t)
+        self._extend('_invalid', invalid)
+        self._set_buffers(self._x, self._y, self._t)
+
+        # Windows that start after the last one we could use before
+        n_valid = len(self._valid_starts)
+        self._extend('_valid_starts', self._find_valid_starts(first=max(n_old - window, 0)))
+
+        # Continue the strides
+        i = np.arange(-(-n_valid // self.stride) * self.stride, len(self._valid_starts), self.stride)
+        if self.random_offset and self.stride > 1:
+            i = np.minimum(i + np.random.randint(0, self.stride, size=len(i)), len(self._valid_starts) - 1)
+        n = len(self._starts)
+        self._extend('_starts', self._valid_starts[i])
+
+        # Inside-out Fisher-Yates, which keeps it a uniform random permutation
+        rs = np.random.RandomState(42 + n)
+        self._extend('_rand_index', np.arange(n, len(self._starts)))
+        r = self._rand_index
+        for k in range(n, len(r)):
+            j = rs.randint(k + 1)
+            r[k], r[j] = r[j], k
+        return self
+
+    def _set_buffers(self, x, y, t):
+        window = self.window_past + self.window_future
+        self._x, self._y, self._t = x, y, t
+        self._xw = window_view(self._x, window)
+        self._yw = window_view(self._y, window)
+        self._tw = window_view(self._t, window)
+
+    def _store_arrays(self):
+        """
+        Move the buffers, and the index arrays, to the mmap files or shared memory if we use them.
+
+        Then a pickle only carries their handles, and the index arrays are about as large as the buffers.
+        """
+        if (self.mmap_dir is None) and not self.shared:
+            return
+        names = [k for k in ['_x', '_y', '_t', '_invalid', '_valid_starts', '_starts', '_rand_index'] if getattr(self, k) is not None]
+        if self.mmap_dir is not None:
+            self.mmap_dir.mkdir(parents=True, exist_ok=True)
+            for k in names:
+                np.save(self._mmap_file(k), getattr(self, k))
+            self._stored = names
+            self._load_mmap()
+        else:
+            self._to_shared_memory(names)
+
+    def _mmap_file(self, name: str) -> Path:
+        return self.mmap_dir / f'{name.lstrip("_")}.npy'
+
+    def _load_mmap(self):
+        for k in self._stored:
+            setattr(self, k, np.load(self._mmap_file(k), mmap_mode='r'))
+        self._set_buffers(self._x, self._y, self._t)
 
+    def _update_stored(self, name: str, a: np.ndarray):
+        """Replace a stored array with one of the same shape."""
+        if self.shared:
+            getattr(self, name)[...] = a
+        else:
+            # Write a new file and swap it in, since the old one is memory mapped
+            tmp = self._mmap_file(name).with_suffix('.tmp.npy')
+            np.save(tmp, a)
+            tmp.replace(self._mmap_file(name))
+            setattr(self, name, np.load(self._mmap_file(name), mmap_mode='r'))
+
+    def _to_shared_memory(self, names):
+        """Copy arrays into new shared memory blocks, owned by this process."""
+        from multiprocessing import shared_memory
+        self._shm_handles = []
+        for k in names:
+            a = getattr(self, k)
+            shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+            b = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+            b[...] = a
+            self._shm.append(shm)
+            self._shm_handles.append((shm.name, a.shape, a.dtype.str))
+            setattr(self, k, b)
+        self._shm_owner = True
+        self._stored = list(names)
+        self._set_buffers(self._x, self._y, self._t)
+
+    def _attach_shared_memory(self):
+        self._shm = [attach_shared_memory(name) for name, _, _ in self._shm_handles]
+        self._shm_owner = False
+        for k, shm, (_, shape, dtype) in zip(self._stored, self._shm, self._shm_handles):
+            setattr(self, k, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+        self._set_buffers(self._x, self._y, self._t)
+
+    def __del__(self):
+        # The process that made the shared memory frees it
+        if getattr(self, '_shm_owner', False):
+            for shm in self._shm:
+                shm.unlink()
+            self._shm_owner = False
+
+    def __getstate__(self):
+        """When memory mapped or shared, pickle (e.g. to DataLoader workers) with only the handles, not the buffers or index arrays."""
+        state = self.__dict__.copy()
+        if (self.mmap_dir is not None) or self.shared:
+            for k in self._stored + ['_xw', '_yw', '_tw']:
+                state[k] = None
+            state['_shm'] = []
+            state['_shm_owner'] = False
+        # The spare capacity isn't worth sending
+        state['_full'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.mmap_dir is not None:
+            self._load_mmap()
+        elif self.shared:
+            self._attach_shared_memory()
+
+    @property
+    def df(self):
+        """The (ffilled) data as a DataFrame, made from the buffers. For display, since we only keep the buffers."""
+        t = pd.DatetimeIndex(np.asarray(self._t).view('datetime64[ns]'))
+        if self.tz is not None:
+            t = t.tz_localize('UTC').tz_convert(self.tz)
+        df = pd.DataFrame(np.asarray(self._x), columns=self.columns_x, index=t)
+        df[self.columns_target] = np.asarray(self._y)
+        return df
+
+    def _rows(self, j):
+        """Start rows for sample(s) j."""
+        j = np.asarray(j)
+        # Handle negative integers
+        j = np.where(j < 0, len(self) + j, j)
+        return self._start_rows(self._rand_index[j])
+
+    def time_order(self):
+        """Sample indices, sorted by time."""
+        return np.argsort(self._rand_index)
+
+    def t_source(self, j):
+        """The present time, i.e. the last past row, for sample(s) j."""
+        return self._t[self._rows(j) + self.window_past - 1].view('datetime64[ns]')
+
+    def t_window(self, j):
+        """All the times in the window, for sample(s) j."""
+        return self._tw[self._rows(j)].view('datetime64[ns]')
+
+    def get_components(self, i):
+        """
+        Get past and future rows, for the window starting on row i.
+
+        This is `_components` for one window, with slices instead of fancy indexing, since a DataLoader calls it for every item.
+        """
+        i = int(i)
+        wp = self.window_past
+        W = wp + self.window_future
+        x, t = self._x[i:i + W], self._t[i:i + W]
+        F = x.shape[1]
+        out = np.empty((W, F + 2), dtype=np.float32)
+        out[:, :F] = x
+        if (self._time_features is not None) and (t[-1] - t[0] == (W - 1) * self._step):
+            out[:, F:] = self._time_features
+        else:
+            days_since_present = (t - t[wp]) * 1e-9 / 60 / 60 / 24  # days
+            out[:, F] = days_since_present
+            out[:, F + 1] = days_since_present < 0
+        y = np.array(self._y[i:i + W], dtype=np.float32)
+        x_past, x_future = out[:wp], out[wp:]
+        np.copyto(x_future, x_past[:1], where=self._blank_mask)
+        return x_past, y[:wp], x_future, y[wp:]
+
+    def get_components_batch(self, i, out=None):
+        """Get past and future rows for an array of start rows, all at once."""
+        return self._components(self._xw[i], self._yw[i], self._tw[i], out=out)
 
     def __getitem__(self, j):
         """This is how python implements square brackets"""
-        if j<0:
+        if not np.isscalar(j):
+            return self.get_batch(j)
+        if self.zero_copy:
+            return self.get_views(j)
+        if j < 0:
             # Handle negative integers
-            j = len(self)+j
-        i = self._rand_index[j]
-        data = self.get_components(i)
-        # From dataframe to torch
-        return [d.astype(np.float32) for d in data]
-    
+            j = len(self) + j
+        return self.get_components(self._start_rows(self._rand_index[j]))
+
+    def get_batch(self, js, out=None):
+        """
+        Get a whole batch of samples in one call.
+
+        Uses fancy indexing instead of building each window in python. Returns x_past, y_past, x_future, y_future with a leading batch dimension.
+
+        Args:
+        - out: Optional float32 arrays to write the batch into, e.g. reused buffers from `seq2seq_time.prefetch.Prefetcher`
+        """
+        return self.get_components_batch(self._rows(js), out=out)
+
+    def get_views(self, j):
+        """Read-only x, y, time windows for sample j. These are views into the buffers, nothing is copied."""
+        i = self._rows(j)
+        return self._xw[i], self._yw[i], self._tw[i]
+
+    def collate(self, views):
+        """Materialize a list of `get_views` windows into a batch, for use as a DataLoader `collate_fn`."""
+        x, y, time = [np.stack(v) for v in zip(*views)]
+        return [torch.from_numpy(d) for d in self._components(x, y, time)]
     
     def get_rows(self, j):
         """
         Output pandas dataframes for display purposes.
         """
-        if j<0:
-            # Handle negative integers
-            j = len(self) + j
-        i = self._rand_index[j]
-        x_cols = list(self.df.drop(columns=self.columns_target).columns) + ['tsp_days', 'is_past']
+        i = self._rows(j)
+        x_cols = self.columns_x + ['tsp_days', 'is_past']
         x_past, y_past, x_future, y_future = self.get_components(i)
-        t_past = self.df.index[i:i+self.window_past]
-        t_future = self.df.index[i+self.window_past:i+self.window_past + self.window_future]
+        t = pd.DatetimeIndex(self._tw[i]).tz_localize('UTC').tz_convert(self.tz)
+        t_past = t[:self.window_past]
+        t_future = t[self.window_past:]
         x_past = pd.DataFrame(x_past, columns=x_cols, index=t_past)
         x_future = pd.DataFrame(x_future, columns=x_cols, index=t_future)
         y_past = pd.DataFrame(y_past, columns=self.columns_target, index=t_past)
@@ -109,43 +593,359 @@ class Seq2SeqDataSet(torch.utils.data.Dataset):
         raise Exception('not implemented')
         
     def __len__(self):
-        return len(self._x) - (self.window_past + self.window_future)
+        return self._n_valid_starts() if self._starts is None else len(self._starts)
     
     def __repr__(self):
-        t = self.df.index
-        return f'<{type(self).__name__}(shape={self.df.shape}, times={t[0]} to {t[1]})>'
+        shape = (len(self._t), self._x.shape[1] + self._y.shape[1])
+        t0, t1 = [pd.Timestamp(t, tz='UTC').tz_convert(self.tz) for t in self._t[[0, -1]]]
+        return f'<{type(self).__name__}(shape={shape}, times={t0} to {t1})>'
+
+
+def ffill(a: np.ndarray) -> np.ndarray:
+    """Forward fill nan's along the first axis of a 2d array."""
+    idx = np.where(np.isnan(a), 0, np.arange(len(a))[:, None])
+    np.maximum.accumulate(idx, axis=0, out=idx)
+    return a[idx, np.arange(a.shape[1])]
+
+
+class Seq2SeqIterableDataSet(WindowFeatures, torch.utils.data.IterableDataset):
+    """
+    Streams windows from a folder made by `save_columnar`, e.g. the normalized cache, for series larger than memory.
+
+    Rows are read in chunks from the memory mapped columns. The last rows of each chunk are kept, so windows can cross chunk boundaries. Windows go through a bounded shuffle buffer, and each DataLoader worker streams its own part of the rows. Like `skip_gaps`, windows with missing targets are skipped.
+    """
+
+    def __init__(self, path, window_past=40, window_future=10, columns_target=['energy(kWh/hh)'], columns_past=[], rows=None, chunksize=2**16, shuffle_buffer=10000, seed=None, dtype=np.float32):
+        """
+        Args:
+        - path: Folder from `save_columnar`, with numeric columns that are already scaled
+        - columns_past: The columns we will blank, in the future
+        - rows: Optional (start, end) rows to use, e.g. a split
+        - chunksize: Rows to read at a time
+        - shuffle_buffer: Number of windows to shuffle between. With 0 they come in time order
+        - seed: Seed for the shuffling, otherwise it's different each time
+        - dtype: dtype of the inputs when read
+        """
+        super().__init__()
+        self.path = Path(path)
+        self.window_past = window_past
+        self.window_future = window_future
+        self.columns_target = columns_target
+        self.columns_past = columns_past
+        self.chunksize = chunksize
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.dtype = dtype
+
+        # Only read the meta data here, the columns are opened in each worker
+        meta, _, index = open_columnar(self.path)
+        names = [m['name'] for m in meta['columns']]
+        self.columns_x = [n for n in names if n not in columns_target]
+        self._icol_blank = [self.columns_x.index(n) for n in columns_past]
+        self._set_blank_mask(len(self.columns_x))
+        self.freq = meta['index']['freq']
+        self.tz = meta['index']['tz']
+        self.rows = tuple(rows) if rows is not None else (0, len(index))
+        self._set_time_features(self.freq)
+
+    def _read(self, columns, names, a, b, dtype):
+        return np.stack([columns[n][a:b] for n in names], 1).astype(dtype, copy=False) if names else np.empty((b - a, 0), dtype=dtype)
+
+    def _windows(self, columns, index, start, end, rs, batch_size=1024):
+        """Yield each valid window between rows start and end, a chunk at a time."""
+        window = self.window_past + self.window_future
+        carry = None  # The last window-1 rows of the previous chunk
+        for a in range(start, end, self.chunksize):
+            b = min(a + self.chunksize, end)
+            x = self._read(columns, self.columns_x, a, b, self.dtype)
+            y = self._read(columns, self.columns_target, a, b, np.float32)
+            t = np.asarray(index[a:b])
+            invalid = np.isnan(y).any(1)
+            if carry is not None:
+                x, y, t, invalid = [np.concatenate([c, d]) for c, d in zip(carry, [x, y, t, invalid])]
+            x = ffill(x)
+            carry = [d[max(len(d) - window + 1, 0):] for d in [x, y, t, invalid]]
+
+            # Windows without missing targets, counted with a cumulative sum like `Seq2SeqDataSet._find_valid_starts`
+            starts = np.arange(max(len(t) - window + 1, 0))
+            n_invalid = np.concatenate([[0], np.cumsum(invalid)])
+            starts = starts[n_invalid[starts + window] == n_invalid[starts]]
+            if self.shuffle_buffer:
+                starts = rs.permutation(starts)
+
+            xw, yw, tw = [window_view(d, window) for d in [x, y, t]]
+            for k in range(0, len(starts), batch_size):
+                i = starts[k:k + batch_size]
+                parts = self._components(xw[i], yw[i], tw[i])
+                for j in range(len(i)):
+                    # Copy, so the shuffle buffer doesn't keep whole batches alive
+                    yield tuple(p[j].copy() for p in parts)
+
+    def __iter__(self):
+        _, columns, index = open_columnar(self.path)
+        window = self.window_past + self.window_future
+        # Like `Seq2SeqDataSet._find_valid_starts`, the window ending on the last row isn't used, so both give the same windows for a split
+        start, end = self.rows[0], max(self.rows[1] - 1, self.rows[0])
+        seed = self.seed
+
+        # Each worker streams its own share of the windows, reading an extra window-1 rows so none are lost
+        info = torch.utils.data.get_worker_info()
+        if info is not None:
+            bounds = np.linspace(0, max(end - start - window + 1, 0), info.num_workers + 1).astype(int)
+            start, end = start + bounds[info.id], min(start + bounds[info.id + 1] + window - 1, end)
+            if seed is not None:
+                seed += info.id
+        rs = np.random.RandomState(seed)
+
+        buffer = []
+        for sample in self._windows(columns, index, start, end, rs):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+            elif self.shuffle_buffer:
+                k = rs.randint(len(buffer))
+                yield buffer[k]
+                buffer[k] = sample
+            else:
+                yield sample
+        rs.shuffle(buffer)
+        yield from buffer
+
+    def __repr__(self):
+        return f'<{type(self).__name__}(path={self.path}, rows={self.rows})>'
+
+
+class Seq2SeqTensorDataSet(torch.utils.data.Dataset):
+    """
+    Keeps the whole series as torch tensors, e.g. on the GPU, and makes batches with tensor ops.
+
+    It's built from a Seq2SeqDataSet so the preprocessing is the same, and returns the same x_past, y_past, x_future, y_future. For small datasets iterate over `batches()` to make a whole epoch without a DataLoader or workers.
+    """
+
+    def __init__(self, ds: Seq2SeqDataSet, device='cpu'):
+        super().__init__()
+        self.window_past = ds.window_past
+        self.window_future = ds.window_future
+        self.columns_target = ds.columns_target
+        self.freq = ds.freq
+        self.device = device
+        window = self.window_past + self.window_future
+
+        self._x = torch.tensor(np.asarray(ds._x), device=device)
+        self._y = torch.tensor(np.asarray(ds._y), device=device)
+        self._t = torch.tensor(np.asarray(ds._t), device=device)
+        self._starts = torch.tensor(ds._start_rows(ds._rand_index), device=device)
+        self._blank_mask = torch.tensor(ds._blank_mask, device=device)
+        self._step = ds._step
+        self._time_features = None
+        if ds._time_features is not None:
+            self._time_features = torch.tensor(ds._time_features, device=device)
+
+        # Views of all windows, shape (windows, window, features)
+        self._xw = self._x.unfold(0, window, 1).transpose(1, 2)
+        self._yw = self._y.unfold(0, window, 1).transpose(1, 2)
+        self._tw = self._t.unfold(0, window, 1)
+
+    def get_batch(self, js):
+        """Get a batch of samples, as tensors on `device`."""
+        js = torch.as_tensor(js, dtype=torch.long, device=self.device)
+        # Handle negative integers
+        js = torch.where(js < 0, js + len(self), js)
+        i = self._starts[js]
+        x = self._xw[i]
+        y = self._yw[i]
+        time = self._tw[i]
+        B, W, F = x.shape
+
+        out = torch.empty((B, W, F + 2), dtype=torch.float32, device=self.device)
+        out[..., :F] = x
+        span = time[:, -1] - time[:, 0]
+        if (self._time_features is not None) and bool((span == (W - 1) * self._step).all()):
+            out[..., F:] = self._time_features
+        else:
+            days_since_present = (time - time[:, self.window_past:self.window_past + 1]) * 1e-9 / 60 / 60 / 24  # days
+            out[..., F] = days_since_present
+            out[..., F + 1] = (days_since_present < 0).float()
+
+        # Split into future and past
+        x_past = out[:, :self.window_past]
+        y_past = y[:, :self.window_past]
+        x_future = out[:, self.window_past:]
+        y_future = y[:, self.window_past:]
+
+        # Stop it cheating by using future weather measurements. Fill in with last value
+        x_future.copy_(torch.where(self._blank_mask, x_past[:, :1], x_future))
+        return x_past, y_past, x_future, y_future
+
+    def __getitem__(self, j):
+        if np.isscalar(j):
+            return [d[0] for d in self.get_batch([j])]
+        return self.get_batch(j)
+
+    def batches(self, batch_size: int, shuffle=False, drop_last=False):
+        """Iterate over an epoch of batches, without a DataLoader."""
+        n = len(self)
+        index = torch.randperm(n, device=self.device) if shuffle else torch.arange(n, device=self.device)
+        for k in range(0, n, batch_size):
+            js = index[k:k + batch_size]
+            if drop_last and len(js) < batch_size:
+                break
+            yield self.get_batch(js)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __repr__(self):
+        return f'<{type(self).__name__}(shape={tuple(self._x.shape)}, device={self.device})>'
+
+
+class Seq2SeqBatchSampler(torch.utils.data.Sampler):
+    """
+    Yields arrays of indices, so a DataLoader can fetch a whole batch with one `get_batch` call.
+
+    Usage:
+        DataLoader(ds, sampler=Seq2SeqBatchSampler(ds, batch_size=64), batch_size=None)
+    """
+
+    def __init__(self, dataset, batch_size: int, shuffle=False, drop_last=False, index=None):
+        """
+        Args:
+        - index: Optional order to go through the samples in, e.g. `ds.time_order()`
+        """
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.index = index
+
+    def __iter__(self):
+        n = len(self.dataset)
+        index = np.arange(n) if self.index is None else np.asarray(self.index)
+        if self.shuffle:
+            index = np.random.permutation(index)
+        for k in range(len(self)):
+            yield index[k * self.batch_size:(k + 1) * self.batch_size]
+
+    def __len__(self):
+        n = len(self.dataset)
+        if self.drop_last:
+            return n // self.batch_size
+        return (n + self.batch_size - 1) // self.batch_size
+
+
+def concat_datasets(datasets: typing.List[Seq2SeqDataSet]) -> Seq2SeqDataSet:
+    """
+    One dataset backed by the concatenated buffers of several.
+
+    The windows still start inside their own block, so they never straddle two blocks. Sample i is the same as sample i of the blocks one after another.
+    """
+    flat = copy.copy(datasets[0])
+    offsets = np.cumsum([0] + [len(d._t) for d in datasets])
+    flat.mmap_dir = None
+    flat.shared = False
+    flat._shm = []
+    flat._shm_owner = False
+    flat._stored = []
+    flat._full = {}
+    flat._set_buffers(
+        np.concatenate([d._x for d in datasets]),
+        np.concatenate([d._y for d in datasets]),
+        np.concatenate([d._t for d in datasets]),
+    )
+    flat._invalid = np.concatenate([d._invalid for d in datasets]) if all(d._invalid is not None for d in datasets) else None
+    flat._valid_starts = np.concatenate([d._all_valid_starts() + o for d, o in zip(datasets, offsets)])
+    flat._starts = np.concatenate([d._all_starts() + o for d, o in zip(datasets, offsets)])
+    # Keep each block's order, so a sample index returns the same window as with separate datasets
+    sample_offsets = np.cumsum([0] + [len(d) for d in datasets])
+    flat._rand_index = np.concatenate([d._rand_index + o for d, o in zip(datasets, sample_offsets)])
+    return flat
 
 
 class Seq2SeqDataSets(torch.utils.data.Dataset):
     """
     Multiple datasets. 
     
-    See Seq2SeqDataSets
+    See Seq2SeqDataSet
     """
-    def __init__(self, dfs: typing.List[pd.DataFrame], **kwargs):
+    def __init__(self, dfs: typing.List[pd.DataFrame], flat=False, **kwargs):
+        """
+        Args:
+        - flat: Concatenate all blocks into one buffer, so a batch can cross blocks without dispatching to each. The blocks become views of it, and with `shared` or `mmap_dir` only it is shared or memory mapped
+        """
+        storage = {k: kwargs.pop(k) for k in ['shared', 'mmap_dir'] if flat and (k in kwargs)}
         self.datasets = [Seq2SeqDataSet(df, **kwargs) for df in dfs]
+        self._offsets = np.cumsum([0] + [len(d) for d in self.datasets])
+        self.flat = None
+        if flat:
+            self.flat = concat_datasets(self.datasets)
+            self.flat.shared = storage.get('shared', False)
+            self.flat.mmap_dir = Path(storage['mmap_dir']) if storage.get('mmap_dir') is not None else None
+            self.flat._store_arrays()
+            self._block_rows = np.cumsum([0] + [len(d._t) for d in self.datasets])
+            self._view_blocks()
+
+    def _view_blocks(self):
+        """Point each block's buffers at its rows of the flat buffers, so the data isn't kept twice."""
+        rows = self._block_rows
+        for d, a, b in zip(self.datasets, rows[:-1], rows[1:]):
+            d._set_buffers(self.flat._x[a:b], self.flat._y[a:b], self.flat._t[a:b])
+            d._invalid = self.flat._invalid[a:b]
+
+    def __getstate__(self):
+        """With a flat buffer, pickle the blocks without their views of it, and make them again after."""
+        state = self.__dict__.copy()
+        if self.flat is not None:
+            state['datasets'] = [copy.copy(d) for d in self.datasets]
+            for d in state['datasets']:
+                d._x = d._y = d._t = d._xw = d._yw = d._tw = d._invalid = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.flat is not None:
+            self._view_blocks()
+
+    def _locate(self, i):
+        """The block, and index within it, for global index(es) i."""
+        i = np.asarray(i)
+        # Handle negative integers
+        i = np.where(i < 0, len(self) + i, i)
+        if np.any((i < 0) | (i >= len(self))):
+            raise IndexError
+        k = np.searchsorted(self._offsets, i, side='right') - 1
+        return k, i - self._offsets[k]
 
     def __getitem__(self, i):
-        l = 0
-        for d in self.datasets:
-            l += len(d)
-            if i < l:
-                return d[l-i]
-        raise IndexError
+        if not np.isscalar(i):
+            return self.get_batch(i)
+        if self.flat is not None:
+            return self.flat[i]
+        k, j = self._locate(i)
+        return self.datasets[k][j]
+
+    def get_batch(self, i, out=None):
+        """Get a batch, with one `get_batch` call per block it touches."""
+        if self.flat is not None:
+            return self.flat.get_batch(i, out=out)
+        k, j = self._locate(i)
+        if out is not None:
+            out = [o[:len(k)] for o in out]
+        for block in np.unique(k):
+            mask = k == block
+            parts = self.datasets[block].get_batch(j[mask])
+            if out is None:
+                out = [np.empty((len(k),) + p.shape[1:], dtype=p.dtype) for p in parts]
+            for o, p in zip(out, parts):
+                o[mask] = p
+        return out
 
     def get_rows(self, i):
-        l = 0
-        for d in self.datasets:
-            l += len(d)
-            if i < l:
-                return d.get_rows(l-i)
-        raise IndexError
+        if self.flat is not None:
+            return self.flat.get_rows(i)
+        k, j = self._locate(i)
+        return self.datasets[k].get_rows(j)
 
     def __len__(self):
-        l = 0
-        for d in self.datasets:
-            l += len(d)
-        return l
+        return self._offsets[-1]
     
     def __repr__(self):
         return f'<{type(self).__name__}({self.datasets})>'
@@ -0,0 +1,142 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+def _bin_starts(t: np.ndarray, step: int):
+    """Integer bin code for each (sorted) time, and where each bin starts."""
+    codes = t // step
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    return codes[starts], starts
+
+
+def _reduce_bins(values: np.ndarray, starts: np.ndarray, how: str) -> np.ndarray:
+    """Aggregate 2d values (columns, time) in each bin, skipping nan's like pandas does."""
+    values = np.ascontiguousarray(values)
+    valid = ~pd.isna(values)
+    if how == 'mean':
+        if valid.all():
+            sums = np.add.reduceat(values.astype(float, copy=False), starts, axis=1)
+            counts = np.diff(np.r_[starts, values.shape[1]])
+        else:
+            sums = np.add.reduceat(np.where(valid, values, 0).astype(float, copy=False), starts, axis=1)
+            counts = np.add.reduceat(valid.astype(np.int64), starts, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / counts
+
+    # For first and last, find the row of the first/last valid value in each bin
+    T = values.shape[1]
+    rows = np.arange(T)[None, :]
+    if how == 'first':
+        pos = np.minimum.reduceat(np.where(valid, rows, T), starts, axis=1)
+        found = pos < T
+    elif how == 'last':
+        pos = np.maximum.reduceat(np.where(valid, rows, -1), starts, axis=1)
+        found = pos >= 0
+    else:
+        raise ValueError(f"how should be 'mean', 'first', or 'last' not {how}")
+    out = np.take_along_axis(values, np.clip(pos, 0, T - 1), axis=1)
+    return np.where(found, out, np.nan)
+
+
+def _resample_values(t: np.ndarray, values: np.ndarray, freq: str, how: str, dense: bool):
+    """
+    Resample 2d values (columns, time) at int64 times t. Returns the times of each bin, and the values.
+
+    Columns first, so each column is contiguous for reduceat.
+    """
+    step = pd.tseries.frequencies.to_offset(freq).nanos
+    if len(t) and np.any(t[1:] < t[:-1]):
+        order = np.argsort(t, kind='stable')
+        t, values = t[order], values[:, order]
+    codes, starts = _bin_starts(t, step)
+    out = _reduce_bins(values, starts, how)
+    if dense and len(codes):
+        # Include empty bins as nan rows
+        full = np.full(out.shape[:1] + (codes[-1] - codes[0] + 1,), np.nan, dtype=out.dtype)
+        full[:, codes - codes[0]] = out
+        codes, out = np.arange(codes[0], codes[-1] + 1), full
+    return codes * step, out
+
+
+def _local_shift(index: pd.DatetimeIndex, freq: str) -> int:
+    """
+    Nanoseconds to add to a tz-aware index's UTC times, so the bins are aligned to local wall time like pandas.
+
+    Across a change in UTC offset (e.g. daylight savings) there is no single shift. Then UTC bins only match local ones if the freq divides every offset.
+    """
+    if index.tz is None or not len(index):
+        return 0
+    step = pd.tseries.frequencies.to_offset(freq).nanos
+    offsets = np.unique(index.tz_localize(None).asi8 - index.asi8)
+    if len(offsets) == 1:
+        return int(offsets[0])
+    if np.all(offsets % step == 0):
+        return 0
+    raise ValueError(f"Can't resample to {freq} bins in local time, as the UTC offset changes. Convert to UTC first, e.g. `df.tz_convert('UTC')`")
+
+
+def resample(data, freq: str, how: str = 'mean', dim: str = 'TIME', dense: bool = True):
+    """
+    Fast resampling onto a regular time grid, using integer bin codes and `np.add.reduceat`.
+
+    Works on a pandas DataFrame/Series with a DatetimeIndex, or an xarray Dataset/DataArray along `dim`. Bins are aligned to the unix epoch in local time, which is the same as pandas for any freq that divides a day. So tz-aware data needs a constant UTC offset, or a freq that divides each offset, otherwise it raises a ValueError.
+
+    Args:
+    - how: 'mean', 'first' or 'last'. These skip nan's, like pandas
+    - dim: The time dimension, for xarray
+    - dense: Include empty bins as nan, like pandas. Otherwise only bins with data are kept
+    """
+    if isinstance(data, pd.Series):
+        return resample(data.to_frame(), freq, how=how, dense=dense)[data.name]
+    if isinstance(data, pd.DataFrame):
+        df = data
+        if how == 'mean':
+            # Like pandas, mean drops non numeric columns
+            df = df._get_numeric_data()
+        index = df.index
+        shift = _local_shift(index, freq)
+        numeric = list(df._get_numeric_data().columns)
+        others = [c for c in df.columns if c not in numeric]
+        columns = {}
+        for names, dtype in [(numeric, float), (others, object)]:
+            if not names:
+                continue
+            values = (df if len(names) == len(df.columns) else df[names]).to_numpy(dtype=dtype)
+            t, out = _resample_values(index.asi8 + shift, values.T, freq, how, dense)
+            columns.update({name: out[i] for i, name in enumerate(names)})
+        if not columns:
+            t, _ = _resample_values(index.asi8 + shift, np.empty((0, len(index))), freq, how, dense)
+        new_index = pd.DatetimeIndex((t - shift).view('datetime64[ns]'), name=index.name)
+        if index.tz is not None:
+            new_index = new_index.tz_localize('UTC').tz_convert(index.tz)
+        if dense:
+            new_index.freq = freq
+        out = pd.DataFrame(columns, index=new_index)[list(df.columns)]
+        for c in others:
+            if isinstance(df[c].dtype, pd.CategoricalDtype):
+                out[c] = out[c].astype(df[c].dtype)
+        return out
+    if isinstance(data, xr.DataArray):
+        name = data.name if data.name is not None else '__data__'
+        return resample(data.to_dataset(name=name), freq, how=how, dim=dim, dense=dense)[name].rename(data.name)
+    if isinstance(data, xr.Dataset):
+        t = data[dim].values.astype('datetime64[ns]').view(np.int64)
+        data_vars = {}
+        for name, v in data.data_vars.items():
+            if dim not in v.dims:
+                data_vars[name] = v
+                continue
+            values = np.moveaxis(v.values, v.dims.index(dim), 0)
+            if not np.issubdtype(values.dtype, np.number):
+                values = values.astype(object) if how != 'mean' else values.astype(float)
+            new_t, out = _resample_values(t, values.reshape(len(t), -1).T, freq, how, dense)
+            out = out.T.reshape((len(new_t),) + values.shape[1:])
+            dims = (dim,) + tuple(d for d in v.dims if d != dim)
+            data_vars[name] = xr.Variable(dims, out, attrs=v.attrs)
+        if not any(dim in v.dims for v in data.data_vars.values()):
+            new_t, _ = _resample_values(t, np.empty((0, len(t))), freq, how, dense)
+        coords = {k: c for k, c in data.coords.items() if dim not in c.dims}
+        coords[dim] = new_t.view('datetime64[ns]')
+        return xr.Dataset(data_vars, coords=coords, attrs=data.attrs)
+    raise TypeError(f'Can only resample pandas or xarray objects, not {type(data)}')
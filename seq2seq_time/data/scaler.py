@@ -0,0 +1,254 @@
+import numpy as np
+import pandas as pd
+import torch
+
+
+class StreamingScaler:
+    """
+    Standardize numeric columns, and ordinal encode categorical ones, in one vectorized transform.
+
+    The mean and variance are fitted in a streaming pass over chunks, merging each chunk with Chan's parallel
+    form of Welford's update. So it can be fitted out of core, or updated as new rows arrive. It replaces the
+    sklearn_pandas `DataFrameMapper` we used before, which `ArrayScaler.from_scaler` can still compile.
+
+    Categories are sorted like `OrdinalEncoder`, and unknown categories are encoded as nan. Note that adding
+    categories with `partial_fit` can change the codes.
+    """
+
+    def __init__(self):
+        self.columns_numeric = None  # Standardized columns, in order
+        self.categories = {}  # Sorted categories for each categorical column
+        self.n_ = None  # Count of non nan values for each numeric column
+        self.mean_ = None
+        self.m2_ = None  # Sum of squared differences from the mean
+
+    @property
+    def columns(self):
+        """Columns in the order they are output"""
+        return self.columns_numeric + list(self.categories)
+
+    @property
+    def var_(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.n_ > 0, self.m2_ / self.n_, np.nan)
+
+    @property
+    def scale_(self):
+        # Like sklearn, don't scale constant columns
+        scale = np.sqrt(self.var_)
+        return np.where(scale == 0, 1.0, scale)
+
+    def partial_fit(self, df: pd.DataFrame):
+        """Update the statistics with a chunk of rows"""
+        if self.columns_numeric is None:
+            self.columns_numeric = list(df._get_numeric_data().columns)
+            self.categories = {c: [] for c in df.columns if c not in self.columns_numeric}
+            self.n_ = np.zeros(len(self.columns_numeric))
+            self.mean_ = np.zeros(len(self.columns_numeric))
+            self.m2_ = np.zeros(len(self.columns_numeric))
+
+        x = df[self.columns_numeric].to_numpy(dtype=np.float64)
+        n_b = (~np.isnan(x)).sum(0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_b = np.where(n_b > 0, np.nansum(x, 0) / n_b, 0)
+        m2_b = np.nansum((x - mean_b)**2, 0)
+
+        # Merge with the previous chunks
+        n = self.n_ + n_b
+        delta = mean_b - self.mean_
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.mean_ = np.where(n > 0, self.mean_ + delta * n_b / n, 0)
+            self.m2_ = np.where(n > 0, self.m2_ + m2_b + delta**2 * self.n_ * n_b / n, 0)
+        self.n_ = n
+
+        for c, categories in self.categories.items():
+            new = set(df[c].dropna().unique())
+            self.categories[c] = sorted(new.union(categories))
+        return self
+
+    def fit(self, df, chunksize: int = 100000):
+        """
+        Fit on a DataFrame, a chunk at a time.
+
+        Args:
+        - df: DataFrame, or an iterable of DataFrame chunks, e.g. from a file that doesn't fit in memory
+        """
+        self.__init__()
+        chunks = df
+        if isinstance(df, pd.DataFrame):
+            chunks = (df.iloc[i:i + chunksize] for i in range(0, max(len(df), 1), chunksize))
+        for chunk in chunks:
+            self.partial_fit(chunk)
+        return self
+
+    def transform(self, df: pd.DataFrame) -> pd.DataFrame:
+        x = (df[self.columns_numeric].to_numpy(dtype=np.float64) - self.mean_) / self.scale_
+        out = pd.DataFrame(x, columns=self.columns_numeric, index=df.index)
+        for c, categories in self.categories.items():
+            codes = pd.Categorical(df[c], categories=categories).codes
+            out[c] = np.where(codes >= 0, codes, np.nan)
+        return out
+
+    def fit_transform(self, df: pd.DataFrame) -> pd.DataFrame:
+        return self.fit(df).transform(df)
+
+    def inverse_transform(self, x):
+        """
+        Undo the transform.
+
+        Args:
+        - x: DataFrame from `transform`, or an array whose last axis is the numeric columns (e.g. one target column)
+        """
+        if not isinstance(x, pd.DataFrame):
+            return np.asarray(x) * self.scale_ + self.mean_
+        out = x[self.columns_numeric] * self.scale_ + self.mean_
+        for c, categories in self.categories.items():
+            codes = x[c].fillna(-1).astype(int)
+            out[c] = pd.Categorical.from_codes(codes, categories=categories)
+        return out
+
+    def subset(self, columns: list) -> 'StreamingScaler':
+        """A scaler for only these columns, e.g. the targets"""
+        out = StreamingScaler()
+        i = [self.columns_numeric.index(c) for c in columns if c in self.columns_numeric]
+        out.columns_numeric = [self.columns_numeric[j] for j in i]
+        out.categories = {c: list(self.categories[c]) for c in columns if c in self.categories}
+        out.n_, out.mean_, out.m2_ = self.n_[i], self.mean_[i], self.m2_[i]
+        return out
+
+    def to_dict(self) -> dict:
+        """A compact, json serializable, representation"""
+        return dict(
+            columns_numeric=self.columns_numeric,
+            categories={c: [v.item() if isinstance(v, np.generic) else v for v in cats] for c, cats in self.categories.items()},
+            n=self.n_.tolist(),
+            mean=self.mean_.tolist(),
+            m2=self.m2_.tolist(),
+        )
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'StreamingScaler':
+        out = cls()
+        out.columns_numeric = list(d['columns_numeric'])
+        out.categories = {c: list(cats) for c, cats in d['categories'].items()}
+        out.n_, out.mean_, out.m2_ = [np.array(d[k], dtype=np.float64) for k in ['n', 'mean', 'm2']]
+        return out
+
+    def __repr__(self):
+        return f'<{type(self).__name__}({len(self.columns_numeric or [])} numeric, {len(self.categories)} categorical)>'
+
+
+class ArrayScaler:
+    """
+    A fitted scaler compiled to a mean and scale vector, plus category lookup tables.
+
+    It transforms numpy arrays or torch tensors in one vectorized call, without building DataFrames, so it's
+    cheap to use on each batch when serving. The last axis is the columns.
+
+    Args:
+    - columns: Column names, in order
+    - mean, scale: One for each column. Categorical columns have a mean of 0 and a scale of 1
+    - categories: The sorted categories, for the categorical columns
+    """
+
+    def __init__(self, columns: list, mean: np.ndarray, scale: np.ndarray, categories: dict = {}):
+        self.columns = list(columns)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.categories = {c: np.asarray(cats, dtype=object) for c, cats in categories.items()}
+        self._lookup = {c: {v: i for i, v in enumerate(cats)} for c, cats in self.categories.items()}
+        self._tensors = {}  # mean and scale, for each torch dtype and device
+
+    @classmethod
+    def from_scaler(cls, scaler, columns: list = None) -> 'ArrayScaler':
+        """
+        Compile a fitted `StreamingScaler`, `DataFrameMapper` of `StandardScaler`/`OrdinalEncoder`'s, or `StandardScaler`.
+
+        Args:
+        - columns: Optional subset of columns, e.g. the targets
+        """
+        if isinstance(scaler, ArrayScaler):
+            # Its categorical columns have a mean and scale too, so leave them out of params
+            categories = scaler.categories
+            params = {c: p for c, p in zip(scaler.columns, zip(scaler.mean, scaler.scale)) if c not in categories}
+        elif isinstance(scaler, StreamingScaler):
+            params = dict(zip(scaler.columns_numeric, zip(scaler.mean_, scaler.scale_)))
+            categories = scaler.categories
+        elif hasattr(scaler, 'features'):
+            # sklearn_pandas.DataFrameMapper with one column per transformer
+            params, categories = {}, {}
+            for names, transformer, *_ in scaler.features:
+                name = names[0] if isinstance(names, list) else names
+                if hasattr(transformer, 'categories_'):
+                    categories[name] = transformer.categories_[0]
+                else:
+                    params[name] = (transformer.mean_[0], transformer.scale_[0])
+        else:
+            # A sklearn StandardScaler, which has no column names
+            params = {i: p for i, p in enumerate(zip(scaler.mean_, scaler.scale_))}
+            categories = {}
+
+        if columns is None:
+            columns = list(params) + list(categories)
+        mean = [params[c][0] if c in params else 0.0 for c in columns]
+        scale = [params[c][1] if c in params else 1.0 for c in columns]
+        return cls(columns, mean, scale, {c: categories[c] for c in columns if c in categories})
+
+    def _params(self, x):
+        """Mean and scale as the same type as x"""
+        if not torch.is_tensor(x):
+            return self.mean, self.scale
+        key = (x.dtype, x.device)
+        if key not in self._tensors:
+            self._tensors[key] = (torch.as_tensor(self.mean, dtype=x.dtype, device=x.device),
+                                  torch.as_tensor(self.scale, dtype=x.dtype, device=x.device))
+        return self._tensors[key]
+
+    def encode(self, x: np.ndarray) -> np.ndarray:
+        """Replace categories with their codes, in an object array. Unknown categories become nan"""
+        x = np.array(x, dtype=object)
+        for c in self.categories:
+            i = self.columns.index(c)
+            lookup = self._lookup[c]
+            x[..., i] = np.vectorize(lambda v: lookup.get(v, np.nan), otypes=[float])(x[..., i])
+        return x.astype(np.float64)
+
+    def decode(self, x: np.ndarray) -> np.ndarray:
+        """Replace codes with their categories, giving an object array"""
+        x = np.array(x, dtype=object)
+        for c, cats in self.categories.items():
+            i = self.columns.index(c)
+            codes = x[..., i].astype(float)
+            valid = ~np.isnan(codes)
+            x[..., i][valid] = cats[codes[valid].astype(int)]
+        return x
+
+    def transform(self, x):
+        """
+        Normalize a numpy array or torch tensor.
+
+        Categorical columns should be codes, or categories in an object array.
+        """
+        if not torch.is_tensor(x):
+            x = np.asarray(x)
+            if x.dtype == object:
+                x = self.encode(x)
+        mean, scale = self._params(x)
+        return (x - mean) / scale
+
+    def inverse_transform(self, x):
+        """Undo the normalization of a numpy array or torch tensor, categorical columns are left as codes"""
+        if not torch.is_tensor(x):
+            x = np.asarray(x)
+        mean, scale = self._params(x)
+        return x * scale + mean
+
+    def inverse_scale(self, x):
+        """Undo only the scaling, e.g. for a standard deviation"""
+        if not torch.is_tensor(x):
+            x = np.asarray(x)
+        mean, scale = self._params(x)
+        return x * scale
+
+    def __repr__(self):
+        return f'<{type(self).__name__}({self.columns})>'
@@ -1,6 +1,7 @@
 import uptide
 import pandas as pd
 import numpy as np
+from functools import lru_cache
 
 # https://en.wikipedia.org/wiki/Theory_of_tides#Harmonic_analysis
 default_tidal_constituents = [
@@ -21,24 +22,69 @@ default_tidal_constituents = [
     'SA'  # Long period
 ]
 
+# Rows in each cached block of `tidal_periods_range`
+_block_size = 4096
+
+
+@lru_cache(maxsize=32)
+def _tide_constants(t0: pd.Timestamp, constituents: tuple):
+    """Nodal factor, angular speed and phase of each constituent. Making a `uptide.Tides` is slow so we cache it."""
+    tide = uptide.Tides(list(constituents))
+    tide.set_initial_time(t0)
+    f = np.asarray(tide.f)
+    omega = np.asarray(tide.omega)
+    phase = np.asarray(tide.phi) + np.asarray(tide.u)
+    return f, omega, phase
+
+
+def tidal_matrix(td: np.ndarray, t0: pd.Timestamp, constituents: list = default_tidal_constituents) -> np.ndarray:
+    """
+    Tidal constituents for seconds since t0, as a float32 (time, constituent) matrix.
+
+    The phase is computed in float64, since omega * td is large.
+    """
+    f, omega, phase = _tide_constants(pd.Timestamp(t0), tuple(constituents))
+    return (f * np.cos(omega * np.asarray(td, dtype=np.float64)[:, None] + phase)).astype(np.float32)
+
 
 def generate_tidal_periods(t: pd.Series,
                            constituents: list = default_tidal_constituents):
-    tide = uptide.Tides(constituents)
-    t0 = t[0]
+    t0 = t.iloc[0]
     td = t - t0
     td = td.dt.total_seconds().to_numpy().astype(int)
-    tide.set_initial_time(t0)
-
-    # calc tides
-    amplitudes = np.ones_like(td)
-    phases = np.zeros_like(td)
-    eta = {}
-    for name, f, amplitude, omega, phase, phi, u in zip(
-            tide.constituents, tide.f, amplitudes, tide.omega, phases,
-            tide.phi, tide.u):
-        eta[name] = f * amplitude * np.cos(omega * td - phase + phi + u)
-    df_eta = pd.DataFrame(eta, index=t)
+    eta = tidal_matrix(td, t0, constituents)
+    df_eta = pd.DataFrame(eta, columns=list(constituents), index=t)
     return df_eta
 
 
+@lru_cache(maxsize=256)
+def _tidal_block(t0: pd.Timestamp, step: int, constituents: tuple, k: int) -> np.ndarray:
+    """Block k of a regular series of tidal constituents, starting at t0 with `step` nanoseconds."""
+    td = (k * _block_size + np.arange(_block_size)) * step // 10**9
+    eta = tidal_matrix(td, t0, constituents)
+    eta.flags.writeable = False
+    return eta
+
+
+def tidal_periods_range(t0: pd.Timestamp, start: pd.Timestamp, periods: int, freq: str,
+                        constituents: list = default_tidal_constituents) -> pd.DataFrame:
+    """
+    Tidal constituents on a regular time range, e.g. future covariates at forecast time.
+
+    It's made from cached blocks on a grid starting at t0, so overlapping ranges reuse earlier work. t0 should be the same one used for the training data, see `generate_tidal_periods`.
+    """
+    t0, start = pd.Timestamp(t0), pd.Timestamp(start)
+    index = pd.date_range(start, periods=periods, freq=freq)
+    step = pd.tseries.frequencies.to_offset(freq).nanos
+    offset = (start - t0).value
+    if offset % step:
+        # Not on the grid, so we can't use the cache
+        td = (index - t0).total_seconds().to_numpy().astype(int)
+        return pd.DataFrame(tidal_matrix(td, t0, constituents), columns=list(constituents), index=index)
+
+    i0 = offset // step
+    k0 = i0 // _block_size
+    k1 = (i0 + periods - 1) // _block_size
+    eta = np.concatenate([_tidal_block(t0, step, tuple(constituents), k) for k in range(k0, k1 + 1)])
+    eta = eta[i0 - k0 * _block_size:][:periods]
+    return pd.DataFrame(eta, columns=list(constituents), index=index)
@@ -1,18 +1,13 @@
-import sklearn
-from sklearn.preprocessing import StandardScaler, OrdinalEncoder
-from sklearn_pandas import DataFrameMapper
-
-def normalize_encode_dataframe(df, encoder=OrdinalEncoder):
-    """Normalise numeric data, encode categorical data."""
-    columns_input_numeric = list(df._get_numeric_data().columns)
-    columns_categorical = list(set(df.columns)-set(columns_input_numeric))
-    
-    transformers= [([n], StandardScaler()) for n in columns_input_numeric] + \
-                  [([n], encoder()) for n in columns_categorical]
-    scaler = DataFrameMapper(transformers, df_out=True)
-    df_norm = scaler.fit_transform(df)
-    return df_norm, scaler
-    
+import json
+import shutil
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# (major, minor) version, for the helpers that depend on pandas internals
+_pandas_version = tuple(int(v) for v in pd.__version__.split('.')[:2])
+
+
 def timeseries_split(df, test_fraction=0.2, dropna=None):
     """Split timeseries data with test in the future"""
     
@@ -27,3 +22,125 @@ def timeseries_split(df, test_fraction=0.2, dropna=None):
     i = int(len(index)*(1- test_fraction))
     dt = index.values[i]
     return df.loc[:dt], df.loc[dt:]
+
+
+def save_columnar(df: pd.DataFrame, path: Path, float_dtype=None):
+    """
+    Save a dataframe as a folder of .npy files, one per column, which can be memory mapped.
+
+    Object and categorical columns are stored as integer codes, with their categories in `meta.json`.
+
+    Args:
+    - float_dtype: Store float columns as this, e.g. np.float32
+    """
+    path = Path(path)
+    tmp = path.with_name(path.name + '.tmp')
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir(parents=True)
+
+    columns = []
+    for i, name in enumerate(df.columns):
+        col = df[name]
+        meta = dict(name=name)
+        if isinstance(col.dtype, pd.CategoricalDtype) or col.dtype == object:
+            cat = col.astype('category').cat
+            a = cat.codes.to_numpy()
+            meta['categories'] = cat.categories.tolist()
+        elif pd.api.types.is_extension_array_dtype(col.dtype):
+            # e.g. the UInt32 from isocalendar
+            a = col.to_numpy(dtype=float if col.isna().any() else col.dtype.numpy_dtype)
+        else:
+            a = col.to_numpy()
+            if (float_dtype is not None) and np.issubdtype(a.dtype, np.floating):
+                a = a.astype(float_dtype, copy=False)
+        np.save(tmp / f'{i}.npy', a)
+        columns.append(meta)
+    np.save(tmp / 'index.npy', df.index.asi8)
+
+    index = dict(name=df.index.name, tz=str(df.index.tz) if df.index.tz else None, freq=df.index.freqstr)
+    (tmp / 'meta.json').write_text(json.dumps(dict(columns=columns, index=index)))
+
+    # Swap in once complete, so an interrupted save never looks like a cache
+    if path.exists():
+        shutil.rmtree(path)
+    tmp.rename(path)
+
+
+def load_columnar(path: Path, columns=None, mmap=True, float_dtype=None) -> pd.DataFrame:
+    """
+    Load a dataframe saved by `save_columnar`.
+
+    Args:
+    - columns: Only load these columns
+    - mmap: Memory map the files (copy on write), so only the pages that are used get read, and processes share them
+    - float_dtype: Downcast float columns, e.g. np.float32
+    """
+    path = Path(path)
+    meta = json.loads((path / 'meta.json').read_text())
+    mmap_mode = 'c' if mmap else None
+
+    data = {}
+    for i, m in enumerate(meta['columns']):
+        if (columns is not None) and (m['name'] not in columns):
+            continue
+        a = np.load(path / f'{i}.npy', mmap_mode=mmap_mode)
+        if 'categories' in m:
+            a = pd.Categorical.from_codes(a, m['categories'])
+        elif (float_dtype is not None) and np.issubdtype(a.dtype, np.floating):
+            # Without a copy if it was saved as float_dtype, so it stays memory mapped
+            a = a.astype(float_dtype, copy=False)
+        data[m['name']] = a
+
+    index = pd.DatetimeIndex(np.load(path / 'index.npy', mmap_mode=mmap_mode).view('datetime64[ns]'), name=meta['index']['name'])
+    if meta['index']['tz']:
+        index = index.tz_localize('UTC').tz_convert(meta['index']['tz'])
+    if meta['index']['freq']:
+        index.freq = meta['index']['freq']
+    return frame_from_columns(data, index)
+
+
+def frame_from_columns(data: dict, index: pd.Index) -> pd.DataFrame:
+    """
+    A DataFrame with one block per column, so the columns stay views of the arrays.
+
+    Consolidating same dtype columns into one block would copy them, and read every memory mapped page. From pandas 1.3, `pd.DataFrame(dict, copy=False)` doesn't consolidate. Before that it always does, so we make the blocks.
+    """
+    if _pandas_version >= (1, 3):
+        return pd.DataFrame(data, index=index, copy=False)
+    from pandas.core.internals import BlockManager, make_block
+    blocks = []
+    for i, a in enumerate(data.values()):
+        if isinstance(a, np.ndarray):
+            a = a[None, :]
+        blocks.append(make_block(a, placement=slice(i, i + 1), ndim=2))
+    return pd.DataFrame(BlockManager(blocks, [pd.Index(list(data)), index]))
+
+
+def datetime_index(t: np.ndarray, dtype, freq=None, name=None) -> pd.DatetimeIndex:
+    """
+    A DatetimeIndex which is a view of int64 UTC nanoseconds t, with a freq that t is known to have.
+
+    The public constructors either copy t to localize it, or check the freq, which are both O(rows). So this uses `_simple_new`, which pandas 1.1 to 2.x have. Otherwise it falls back to the public ones.
+    """
+    try:
+        values = pd.arrays.DatetimeArray._simple_new(t.view('datetime64[ns]'), freq=freq, dtype=dtype)
+        return pd.DatetimeIndex._simple_new(values, name=name)
+    except (AttributeError, TypeError):
+        index = pd.DatetimeIndex(t.view('datetime64[ns]'), name=name)
+        if getattr(dtype, 'tz', None) is not None:
+            index = index.tz_localize('UTC').tz_convert(dtype.tz)
+        return pd.DatetimeIndex(index, freq=freq)
+
+
+def open_columnar(path: Path):
+    """
+    Memory map each column of a `save_columnar` folder, without building a DataFrame.
+
+    Returns the meta data, a dict of arrays for each column, and the index as int64 nanoseconds.
+    """
+    path = Path(path)
+    meta = json.loads((path / 'meta.json').read_text())
+    columns = {m['name']: np.load(path / f'{i}.npy', mmap_mode='r') for i, m in enumerate(meta['columns'])}
+    index = np.load(path / 'index.npy', mmap_mode='r')
+    return meta, columns, index
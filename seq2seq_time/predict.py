@@ -2,8 +2,12 @@ import xarray as xr
 import torch
 from tqdm.auto import tqdm
 import pandas as pd
+import numpy as np
 
 from .util import to_numpy
+from .data.dataset import Seq2SeqBatchSampler
+from .data.scaler import ArrayScaler
+from .prefetch import Prefetcher
 
 def predict(model, ds_test, batch_size, device='cpu', scaler=None):
     """
@@ -16,29 +20,51 @@ def predict(model, ds_test, batch_size, device='cpu', scaler=None):
 
     It's hard to use pandas for data with virtual dimensions so we will use xarray. Xarray has an interface similar to pandas but also allows coordinates which are virtual dimensions.
     """
-    load_test = torch.utils.data.dataloader.DataLoader(ds_test, batch_size=batch_size)
-    freq = ds_test.df.index.freq
+    # Go through in time order, and keep track of the source times, since the dataset may be shuffled or strided
+    batches = list(Seq2SeqBatchSampler(ds_test, batch_size, index=ds_test.time_order()))
+    freq = ds_test.freq
+    if scaler:
+        # Compile the scaler so we can undo scaling on y for each batch, on the device
+        scaler = ArrayScaler.from_scaler(scaler)
     xrs = []
-    for i, batch in enumerate(tqdm(load_test, desc='predict', leave=False)):
+    # The next batches are built in the background while the model runs
+    for js, batch in zip(tqdm(batches, desc='predict', leave=False), Prefetcher(ds_test, batches)):
         model.eval()
         with torch.no_grad():
             x_past, y_past, x_future, y_future = [d.to(device) for d in batch]
             y_dist, extra = model(x_past, y_past, x_future)
             nll = -y_dist.log_prob(y_future)
+            mean, std = y_dist.loc, y_dist.scale
+
+            # undo scaling on y
+            if scaler:
+                mean = scaler.inverse_transform(mean)
+                std = scaler.inverse_scale(std)
+                y_future = scaler.inverse_transform(y_future)
+                y_past = scaler.inverse_transform(y_past)
 
             # Convert to numpy
-            mean = to_numpy(y_dist.loc.squeeze(-1))
-            std = to_numpy(y_dist.scale.squeeze(-1))
+            mean = to_numpy(mean.squeeze(-1))
+            std = to_numpy(std.squeeze(-1))
             nll = to_numpy(nll.squeeze(-1))
-            y_future = to_numpy(y_future.squeeze(-1))
-            y_past = to_numpy(y_past.squeeze(-1))    
+            # Copy, since the prefetcher reuses the batch tensors
+            y_future = to_numpy(y_future.squeeze(-1)).copy()
+            y_past = to_numpy(y_past.squeeze(-1)).copy()
 
         # Make an xarray.Dataset for the data
-        bs = y_future.shape[0]
-        wp = ds_test.window_past
-        t_source = ds_test.df.index[wp + i*bs -1:wp+ i*bs+bs -1].values
-        t_ahead = pd.timedelta_range(1, periods=ds_test.window_future, freq=freq).values
-        t_behind = pd.timedelta_range(end=0, periods=ds_test.window_past, freq=freq)
+        t_source = ds_test.t_source(js)
+        coords = {}
+        if freq is not None:
+            # t_source is the last past row, so the first target is one step ahead
+            t_ahead = pd.timedelta_range(0, periods=ds_test.window_future + 1, freq=freq)[1:].values
+            t_behind = pd.timedelta_range(end=0, periods=ds_test.window_past, freq=freq)
+        else:
+            # Without a freq, the steps have different lengths, so use step numbers and record the actual times
+            t_ahead = np.arange(1, ds_test.window_future + 1)
+            t_behind = np.arange(-ds_test.window_past + 1, 1)
+            t_window = ds_test.t_window(js)
+            coords = {"t_past": (["t_source", "t_behind"], t_window[:, :ds_test.window_past]),
+                      "t_target": (["t_source", "t_ahead"], t_window[:, ds_test.window_past:])}
         xr_out = xr.Dataset(
             {
                 # Format> name: ([dimensions,...], array),
@@ -48,20 +74,20 @@ def predict(model, ds_test, batch_size, device='cpu', scaler=None):
                 "y_pred_std": (["t_source", "t_ahead",], std),
                 "y_true": (["t_source", "t_ahead",], y_future),
             },
-            coords={"t_source": t_source, "t_ahead": t_ahead, "t_behind": t_behind},
+            coords={"t_source": t_source, "t_ahead": t_ahead, "t_behind": t_behind, **coords},
             attrs={'freq': str(ds_test.freq), "model": str(type(model)), "targets": ds_test.columns_target}
         )
         xrs.append(xr_out)
 
     # Join all batches
     ds_preds = xr.concat(xrs, dim="t_source")
-    
-    # undo scaling on y
-    if scaler:
-        ds_preds['y_pred_std'].values = ds_preds.y_pred_std * scaler.scale_
-        ds_preds['y_past'].values =  scaler.inverse_transform(ds_preds.y_past)
-        ds_preds['y_pred'].values =  scaler.inverse_transform(ds_preds.y_pred)
-        ds_preds['y_true'].values =  scaler.inverse_transform(ds_preds.y_true)
+
+    if freq is None:
+        # The steps have different lengths, so use the median step for the time ahead in hours
+        t_window = np.concatenate([ds_preds.t_past.values, ds_preds.t_target.values], axis=1)
+        step = np.median(np.diff(t_window.astype(np.int64), axis=1))
+        ds_preds = ds_preds.assign_coords(t_ahead_hours=(ds_preds.t_ahead*step*1.0e-9/60/60).astype(float))
+        return ds_preds
 
     # Add some derived coordinates, they will be the ones not in bold
     # The target time, is a function of the source time, and how far we predict ahead
@@ -70,7 +96,7 @@ def predict(model, ds_test, batch_size, device='cpu', scaler=None):
     ds_preds = ds_preds.assign_coords(t_past=ds_preds.t_source+ds_preds.t_behind)
 
     # Some plots don't like timedeltas, so lets make a coordinate for time ahead in hours
-    ds_preds = ds_preds.assign_coords(t_ahead_hours=(ds_preds.t_ahead*1.0e-9/60/60).astype(float))
+    ds_preds = ds_preds.assign_coords(t_ahead_hours=ds_preds.t_ahead / np.timedelta64(1, 'h'))
     return ds_preds
 
 def predict_multi(model, datasets, batch_size, device='cpu', scaler=None):
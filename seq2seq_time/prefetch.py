@@ -0,0 +1,87 @@
+import threading
+import queue
+import itertools
+import torch
+
+
+class Prefetcher:
+    """
+    Builds the next batches in a background thread, while the model runs on the current one.
+
+    Batches are written into a ring of preallocated float32 tensors with `get_batch(js, out=...)`, so no tensors are made for each batch. numpy releases the GIL while it copies, so this overlaps with the forward and backward pass.
+
+    The tensors are reused, so a batch is only valid until the next one is requested. Move it to the device, or copy it, to keep it.
+
+    Usage:
+        for x_past, y_past, x_future, y_future in Prefetcher(ds, Seq2SeqBatchSampler(ds, 64, shuffle=True)):
+            ...
+    """
+
+    def __init__(self, dataset, sampler, n=2, pin_memory=False):
+        """
+        Args:
+        - dataset: Has `get_batch(js, out=...)`, like Seq2SeqDataSet
+        - sampler: Yields arrays of indices, like Seq2SeqBatchSampler
+        - n: How many batches to build ahead
+        - pin_memory: Pin the tensors, for faster copies to the GPU
+        """
+        self.dataset = dataset
+        self.sampler = sampler
+        self.n = n
+        self.pin_memory = pin_memory
+
+    def _allocate(self, js, batch_size: int):
+        """One slot of the ring, shaped like a batch from the dataset"""
+        parts = self.dataset.get_batch(js[:1])
+        return [torch.empty((batch_size,) + p.shape[1:], dtype=torch.float32, pin_memory=self.pin_memory) for p in parts]
+
+    def _worker(self, batches, free, filled, stop):
+        try:
+            for js in batches:
+                slot = free.get()
+                if stop.is_set():
+                    return
+                batch = [t[:len(js)] for t in slot]
+                self.dataset.get_batch(js, out=[t.numpy() for t in batch])
+                filled.put((slot, batch))
+        except Exception as e:
+            filled.put(e)
+            return
+        filled.put(None)
+
+    def __iter__(self):
+        it = iter(self.sampler)
+        first = next(it, None)
+        if first is None:
+            return
+        batch_size = getattr(self.sampler, 'batch_size', len(first))
+
+        # One slot for each batch ahead, and one for the batch being used
+        free = queue.Queue()
+        for _ in range(self.n + 1):
+            free.put(self._allocate(first, batch_size))
+        filled = queue.Queue()
+        stop = threading.Event()
+        thread = threading.Thread(target=self._worker, args=(itertools.chain([first], it), free, filled, stop), daemon=True)
+        thread.start()
+
+        slot = None
+        try:
+            while True:
+                item = filled.get()
+                if slot is not None:
+                    free.put(slot)
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                slot, batch = item
+                yield batch
+        finally:
+            # Let the thread finish, if we stopped early
+            stop.set()
+            free.put(None)
+            thread.join()
+
+    def __len__(self):
+        return len(self.sampler)